@@ -0,0 +1,53 @@
+import os
+import shutil
+
+# Gunicorn configuration for serving the Flask application in production
+# Run: gunicorn --config gunicorn.conf.py
+wsgi_app = "app:create_app()"
+pythonpath = "server"
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# Worker processes (Each worker creates its own Firestore, Gemini and Open Food Facts clients)
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * os.cpu_count() + 1))
+# Threads per worker (Requests mostly wait on upstream I/O, so threads add concurrency cheaply)
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+# Import the application after fork (gRPC channels and background threads do not survive a fork)
+preload_app = False
+
+# Request timeout and graceful shutdown window (in seconds)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# Restart workers periodically to bound memory growth from the in-process caches
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = 100
+
+accesslog = "-"
+errorlog = "-"
+
+# Directory where each worker writes its Prometheus metrics (Aggregated by the /metrics route)
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus")
+
+
+# Start with an empty metrics directory so values from a previous run are not reported
+def on_starting(server):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+# Remove the live gauges of a worker that exited (Runs in the master process)
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+# Flush the queued Firestore writes and stop the thread pool before a worker exits
+def worker_exit(server, worker):
+    from database import write_queue
+    from workers import executor
+
+    write_queue.flush()
+    executor.shutdown(wait=False, cancel_futures=True)
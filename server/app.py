@@ -1,53 +1,94 @@
+import click
 from flask import Flask, jsonify
-from config import FLASK_SECRET_KEY
+from config import FLASK_SECRET_KEY, REQUEST_MAX_SIZE
 from auth import auth_blueprint
 from search import search_blueprint
 from gemini import ai_blueprint
 from user import user_blueprint
 from chat import chat_blueprint
 from flask_cors import CORS
-from middleware import auth_handler, error_handler
-
-app = Flask(__name__)  # Initialize Flask application instance
-app.secret_key = FLASK_SECRET_KEY  # Set the Flask secret key for session management
-
-# Register blueprints for API routes
-app.register_blueprint(auth_blueprint, url_prefix="/api/v1/auth")
-app.register_blueprint(search_blueprint, url_prefix="/api/v1/search")
-app.register_blueprint(ai_blueprint, url_prefix="/api/v1/ai")
-app.register_blueprint(user_blueprint, url_prefix="/api/v1/user")
-app.register_blueprint(chat_blueprint, url_prefix="/api/v1/chat")
-
-# Register middleware functions for authentication and error handling
-app.before_request(auth_handler)
-app.register_error_handler(Exception, error_handler)
-
-# Enable CORS for all routes under /api/*
-CORS(
-    app,
-    resources={
-        r"/api/*": {
-            "origins": [
-                "https://mivro.1mindlabs.org",
-                "http://localhost:3000",
-            ],
-            "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-            "allow_headers": [
-                "Content-Type",
-                "Authorization",
-                "Mivro-Email",
-                "Mivro-Password",
-            ],
-            "supports_credentials": True,
-        }
-    },
+from middleware import auth_handler, error_handler, size_error_handler
+from werkzeug.exceptions import RequestEntityTooLarge
+from metrics import (
+    finish_request_timer,
+    metrics_blueprint,
+    record_request_metrics,
+    start_request_timer,
 )
+from database import migrate_user_history, user_reference
+from catalog import import_catalog
+
+
+# Command for moving the legacy scan/chat history of every user into subcollections (Run: flask migrate-history)
+def migrate_history() -> None:
+    user_stream = user_reference.select(["scan_history", "chat_history"]).stream()
+    for user_document in user_stream:
+        migrate_user_history(user_document.id, user_document.to_dict())
+
+
+# Command for building the local product catalog from an Open Food Facts JSONL dump (Run: flask import-catalog <dump_path>)
+@click.argument("dump_path", type=click.Path(exists=True, dir_okay=False))
+def build_catalog(dump_path: str) -> None:
+    product_count = import_catalog(dump_path)
+    print(f"[Catalog] Imported {product_count} products from {dump_path}")
 
 
-@app.route("/health", methods=["GET"])
 def health():
     return jsonify({"status": "ok"}), 200
 
 
+# Application factory (Used by "flask run" and by each Gunicorn worker after it is forked)
+def create_app() -> Flask:
+    app = Flask(__name__)  # Initialize Flask application instance
+    app.secret_key = FLASK_SECRET_KEY  # Set the Flask secret key for session management
+    # Reject larger request bodies before they are parsed and buffered (Savora media files are the largest)
+    app.config["MAX_CONTENT_LENGTH"] = REQUEST_MAX_SIZE
+
+    # Register blueprints for API routes
+    app.register_blueprint(auth_blueprint, url_prefix="/api/v1/auth")
+    app.register_blueprint(search_blueprint, url_prefix="/api/v1/search")
+    app.register_blueprint(ai_blueprint, url_prefix="/api/v1/ai")
+    app.register_blueprint(user_blueprint, url_prefix="/api/v1/user")
+    app.register_blueprint(chat_blueprint, url_prefix="/api/v1/chat")
+    app.register_blueprint(metrics_blueprint)
+
+    # Register the request metrics hooks (Before authentication, so rejected requests are counted)
+    app.before_request(start_request_timer)
+    app.after_request(record_request_metrics)
+    app.teardown_request(finish_request_timer)
+
+    # Register middleware functions for authentication and error handling
+    app.before_request(auth_handler)
+    app.register_error_handler(Exception, error_handler)
+    app.register_error_handler(RequestEntityTooLarge, size_error_handler)
+
+    # Enable CORS for all routes under /api/*
+    CORS(
+        app,
+        resources={
+            r"/api/*": {
+                "origins": [
+                    "https://mivro.1mindlabs.org",
+                    "http://localhost:3000",
+                ],
+                "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+                "allow_headers": [
+                    "Content-Type",
+                    "Authorization",
+                    "Mivro-Email",
+                    "Mivro-Password",
+                ],
+                "supports_credentials": True,
+            }
+        },
+    )
+
+    # Register the health check route and the CLI commands
+    app.add_url_rule("/health", view_func=health, methods=["GET"])
+    app.cli.command("migrate-history")(migrate_history)
+    app.cli.command("import-catalog")(build_catalog)
+    return app
+
+
 # if __name__ == "__main__":
-#     app.run(host="0.0.0.0", port=5000, debug=True)  # Run the app on localhost:5000 in debug mode
+#     create_app().run(host="0.0.0.0", port=5000, debug=True)  # Run the app on localhost:5000 in debug mode
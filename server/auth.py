@@ -1,12 +1,15 @@
 from flask import Blueprint, Response, jsonify, request, session
 from firebase_admin import auth
 from database import (
+    invalidate_user_document,
+    move_user_history,
     register_user_profile,
     remove_user_profile,
     runtime_error,
     user_reference,
     validate_user_profile,
 )
+from middleware import invalidate_credentials
 
 # Blueprint for the authentication routes
 auth_blueprint = Blueprint("auth", __name__)
@@ -114,7 +117,11 @@ def update_email() -> Response:
         # Create a new user document with the new email and delete the old one (Workdaround for Firestore not supporting document ID updates)
         new_user_document = user_reference.document(new_email)
         new_user_document.set(current_user_document.get().to_dict())
+        move_user_history(current_email, new_email)
         current_user_document.delete()
+        invalidate_user_document(current_email)
+        invalidate_user_document(new_email)
+        invalidate_credentials(current_email)
 
         # Update the email in the session if the user is logged in
         if "email" in session and session["email"] == current_email:
@@ -148,6 +155,7 @@ def delete_account() -> Response:
         user = auth.get_user_by_email(email)
         auth.delete_user(user.uid)  # Delete the user from Firebase Auth
         result = remove_user_profile(email)  # Remove the user from Firestore database
+        invalidate_credentials(email)
         if "error" in result:
             return jsonify(result), 500
 
@@ -0,0 +1,166 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from config import SHARED_CACHE_ENABLED
+from database import cache_reference
+from metrics import CACHE_REQUESTS, track_upstream
+
+
+# Cache with an in-process LRU tier and an optional shared Firestore tier
+# Entries are fresh until "ttl", then served stale (while being refreshed) until "stale_ttl"
+class TieredCache:
+    def __init__(
+        self,
+        name: str,
+        max_size: int,
+        ttl: int,
+        stale_ttl: int = 0,
+        negative_ttl: int = 0,
+        shared: bool = False,
+    ):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()  # key -> (value, fresh_until, stale_until)
+        self.refreshing = set()  # Keys with a background refresh in progress
+        self.lock = threading.Lock()
+        self.shared_reference = (
+            cache_reference.document(name).collection("entries")
+            if shared and SHARED_CACHE_ENABLED
+            else None
+        )
+
+    # Function for reading an entry and recording the lookup result (Returns found, value, fresh)
+    def get(self, key: str) -> tuple:
+        found, value, fresh = self.read(key)
+        result = "miss" if not found else ("hit" if fresh else "stale")
+        CACHE_REQUESTS.labels(self.name, result).inc()
+        return found, value, fresh
+
+    # Function for reading an entry from the local tier, then the shared tier
+    def read(self, key: str) -> tuple:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[2] > now:
+                self.entries.move_to_end(key)  # Mark as most recently used
+                return True, copy.deepcopy(entry[0]), entry[1] > now
+            if entry:
+                del self.entries[key]  # Drop the expired entry
+
+        if self.shared_reference is None:
+            return False, None, False
+
+        try:
+            with track_upstream("firestore", "cache.get"):
+                shared_document = self.shared_reference.document(
+                    self.shared_key(key)
+                ).get()
+            if not shared_document.exists:
+                return False, None, False
+
+            shared_entry = shared_document.to_dict()
+            if shared_entry["stale_until"] <= now:
+                return False, None, False
+
+            # Promote the shared entry to the local tier for subsequent reads
+            value = json.loads(shared_entry["value"])
+            self.store(
+                key, value, shared_entry["fresh_until"], shared_entry["stale_until"]
+            )
+            return True, value, shared_entry["fresh_until"] > now
+        except Exception as exc:
+            print(f'[Cache] Shared read failed for "{self.name}": {exc}')
+            return False, None, False
+
+    # Function for writing an entry to both tiers (Uses negative_ttl for empty values)
+    def set(self, key: str, value, ttl: int = None) -> None:
+        ttl = ttl if ttl is not None else (self.ttl if value else self.negative_ttl)
+        if ttl <= 0:
+            return
+
+        fresh_until = time.time() + ttl
+        stale_until = fresh_until + (self.stale_ttl if value else 0)
+        self.store(key, copy.deepcopy(value), fresh_until, stale_until)
+
+        if self.shared_reference is None:
+            return
+
+        try:
+            with track_upstream("firestore", "cache.set"):
+                self.shared_reference.document(self.shared_key(key)).set(
+                    {
+                        "key": key,
+                        "value": json.dumps(value),
+                        "fresh_until": fresh_until,
+                        "stale_until": stale_until,
+                    }
+                )
+        except Exception as exc:
+            print(f'[Cache] Shared write failed for "{self.name}": {exc}')
+
+    # Function for removing an entry from both tiers
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+        if self.shared_reference is not None:
+            try:
+                self.shared_reference.document(self.shared_key(key)).delete()
+            except Exception as exc:
+                print(f'[Cache] Shared delete failed for "{self.name}": {exc}')
+
+    # Function for removing every entry from the local tier
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    # Function for returning a cached value or loading it (Stale values are refreshed in the background)
+    def fetch(self, key: str, loader):
+        found, value, fresh = self.get(key)
+        if found and fresh:
+            return value
+
+        if found:
+            self.refresh(key, loader)
+            return value
+
+        value = loader()
+        self.set(key, value)
+        return value
+
+    # Function for reloading a stale entry in a background thread (At most one refresh per key)
+    def refresh(self, key: str, loader) -> None:
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def reload():
+            try:
+                self.set(key, loader())
+            except Exception as exc:
+                print(f'[Cache] Refresh failed for "{self.name}" -> "{key}": {exc}')
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=reload, daemon=True).start()
+
+    # Function for storing an entry in the local tier and evicting the least recently used entries
+    def store(self, key: str, value, fresh_until: float, stale_until: float) -> None:
+        with self.lock:
+            self.entries[key] = (value, fresh_until, stale_until)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Function for mapping a cache key to a valid Firestore document ID
+    def shared_key(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
@@ -0,0 +1,206 @@
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from utils import normalize_query, product_schema
+from config import CATALOG_IMPORT_BATCH_SIZE, CATALOG_PATH
+
+# Fields of a product that are split into tokens for the text search index
+TOKEN_FIELDS = ["product_name", "brands", "categories", "_keywords"]
+
+CATALOG_SCHEMA = """
+CREATE TABLE products (
+    id INTEGER PRIMARY KEY,
+    code TEXT NOT NULL UNIQUE,
+    popularity INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE TABLE tokens (
+    token TEXT NOT NULL,
+    product_id INTEGER NOT NULL
+);
+"""
+
+# Each thread keeps its own read-only connection (Reopened after the catalog file is replaced by an import)
+connections = threading.local()
+
+
+# Function for splitting product text into normalized search tokens
+def tokenize(text: str) -> set:
+    return set(re.findall(r"\w{2,}", normalize_query(text)))
+
+
+# Function for collecting the search tokens of a product
+def product_tokens(product: dict) -> set:
+    tokens = set()
+    for field in TOKEN_FIELDS:
+        value = product.get(field) or ""
+        if isinstance(value, list):
+            value = " ".join(str(item) for item in value)
+        tokens.update(tokenize(str(value)))
+    return tokens
+
+
+# Function for opening the catalog of the current thread (Returns None if no catalog has been imported)
+def catalog_connection() -> sqlite3.Connection:
+    try:
+        catalog_version = os.stat(CATALOG_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if getattr(connections, "version", None) != catalog_version:
+        if getattr(connections, "connection", None):
+            connections.connection.close()
+        connections.connection = sqlite3.connect(
+            f"file:{CATALOG_PATH}?mode=ro", uri=True
+        )
+        connections.version = catalog_version
+    return connections.connection
+
+
+# Function for finding a product by barcode in the local catalog (Returns None if it is not indexed)
+def find_product(product_barcode: str) -> dict:
+    connection = catalog_connection()
+    if not connection:
+        return None
+
+    row = connection.execute(
+        "SELECT data FROM products WHERE code = ?", (product_barcode,)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+# Function for searching products by text in the local catalog (Same shape as the Open Food Facts search result)
+def search_catalog(search_query: str, page: int, page_size: int) -> dict:
+    connection = catalog_connection()
+    query_tokens = sorted(tokenize(search_query))
+    if not connection or not query_tokens:
+        return None
+
+    # Match the products that contain every token of the query, most popular first
+    placeholders = ", ".join("?" for _ in query_tokens)
+    matches = f"""
+        SELECT product_id FROM tokens WHERE token IN ({placeholders})
+        GROUP BY product_id HAVING COUNT(*) = ?
+    """
+    parameters = [*query_tokens, len(query_tokens)]
+
+    count = connection.execute(
+        f"SELECT COUNT(*) FROM ({matches})", parameters
+    ).fetchone()[0]
+    if not count:
+        return None
+
+    skip = (page - 1) * page_size
+    rows = connection.execute(
+        f"""
+        SELECT products.data FROM products JOIN ({matches}) AS matches
+        ON matches.product_id = products.id
+        ORDER BY products.popularity DESC, products.id LIMIT ? OFFSET ?
+        """,
+        [*parameters, page_size, skip],
+    ).fetchall()
+    if not rows:
+        return None
+
+    return {
+        "count": count,
+        "page": page,
+        "page_count": len(rows),
+        "page_size": page_size,
+        "skip": skip,
+        "products": [json.loads(row[0]) for row in rows],
+    }
+
+
+# Function for building the local catalog from an Open Food Facts JSONL dump (.jsonl or .jsonl.gz)
+def import_catalog(dump_path: str) -> int:
+    os.makedirs(os.path.dirname(CATALOG_PATH), exist_ok=True)
+    temp_path = f"{CATALOG_PATH}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    connection = sqlite3.connect(temp_path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.executescript(CATALOG_SCHEMA)
+
+    pending_products = {}  # Product barcode -> (popularity, product data, tokens)
+    product_count = 0
+    open_dump = gzip.open if dump_path.endswith(".gz") else open
+
+    # Stream the dump line by line (It is far too large to load into memory)
+    with open_dump(dump_path, "rt", encoding="utf-8") as dump_file:
+        for line in dump_file:
+            try:
+                product = json.loads(line)
+            except ValueError:
+                continue
+
+            # Keep the first product of a repeated barcode
+            product_barcode = str(product.get("code") or "")
+            if not product_barcode or product_barcode in pending_products:
+                continue
+
+            # Keep the product schema fields only (Same fields as the Open Food Facts API lookups)
+            product_data = {
+                field: product[field] for field in product_schema if field in product
+            }
+            pending_products[product_barcode] = (
+                product.get("unique_scans_n") or 0,
+                json.dumps(product_data),
+                product_tokens(product_data),
+            )
+
+            if len(pending_products) >= CATALOG_IMPORT_BATCH_SIZE:
+                product_count += insert_rows(
+                    connection, pending_products, product_count
+                )
+                pending_products = {}
+
+    product_count += insert_rows(connection, pending_products, product_count)
+
+    # Build the token index after the import (Much faster than updating it on every insert)
+    connection.execute("CREATE INDEX tokens_index ON tokens (token, product_id)")
+    connection.commit()
+    connection.close()
+
+    # Replace the catalog in one step so running workers never read a partial import
+    os.replace(temp_path, CATALOG_PATH)
+    return product_count
+
+
+# Function for inserting one batch of products and their tokens into the catalog (Returns the number of products inserted)
+# Barcodes already imported by an earlier batch are skipped before the IDs are assigned, so every token row matches its product
+def insert_rows(
+    connection: sqlite3.Connection, pending_products: dict, last_id: int
+) -> int:
+    imported_codes = {
+        row[0]
+        for row in connection.execute(
+            "SELECT code FROM products WHERE code IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(pending_products)),),
+        )
+    }
+
+    product_rows, token_rows = [], []
+    for product_barcode, (popularity, data, tokens) in pending_products.items():
+        if product_barcode in imported_codes:
+            continue
+
+        product_id = last_id + len(product_rows) + 1
+        product_rows.append((product_id, product_barcode, popularity, data))
+        token_rows.extend((token, product_id) for token in tokens)
+
+    connection.executemany(
+        "INSERT INTO products (id, code, popularity, data) VALUES (?, ?, ?, ?)",
+        product_rows,
+    )
+    connection.executemany(
+        "INSERT INTO tokens (token, product_id) VALUES (?, ?)", token_rows
+    )
+    connection.commit()
+    return len(product_rows)
@@ -1,6 +1,13 @@
-import requests
 from flask import Blueprint, Response, jsonify, request
-from database import runtime_error, user_reference
+from database import (
+    chat_reference,
+    delete_chat_messages,
+    history_page,
+    runtime_error,
+)
+from gemini import savora_reply
+from upstream import SchedulerOverloaded
+from utils import history_page_size
 
 # Blueprint for the chat routes
 chat_blueprint = Blueprint("chat", __name__)
@@ -14,10 +21,21 @@ def load_message() -> Response:
         return jsonify({"error": "Email is required."}), 400
 
     try:
-        # Reference the user document by email and retrieve the chat history data
-        user_document = user_reference.document(email)
-        user_data = user_document.get().to_dict()
-        return jsonify(user_data.get("chat_history", []))
+        # Retrieve the whole chat history in the order the messages were sent (Unless a page is requested)
+        if "cursor" not in request.args and "page_size" not in request.args:
+            chat_stream = chat_reference(email).order_by("created_at").stream()
+            return jsonify([chat_document.to_dict() for chat_document in chat_stream])
+
+        # Retrieve one page of the chat history, newest message first
+        chat_page = history_page(
+            chat_reference(email),
+            "created_at",
+            history_page_size(request.args),
+            cursor=request.args.get("cursor"),
+        )
+        return jsonify(chat_page)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
     except Exception as exc:
         runtime_error("load_message", str(exc), email=email)
         return jsonify({"error": str(exc)}), 500
@@ -37,46 +55,25 @@ def update_message() -> Response:
         )
 
     try:
-        # Reference the user document by email and retrieve the chat history
-        user_document = user_reference.document(email)
-        chat_history = user_document.get().to_dict().get("chat_history", [])
-
-        # Delete the old message from the chat history
-        new_chat_history = [
-            record
-            for record in chat_history
-            if record.get("user_message") != old_message
-        ]
-
-        # Check if the old message was found and deleted
-        if len(new_chat_history) == len(chat_history):
+        # Delete the old message from the chat history and check if it was found
+        if not delete_chat_messages(email, old_message):
             return jsonify({"error": "Old message not found in chat history."}), 404
 
-        # Save the updated chat history to the database after deleting the old message
-        user_document.update({"chat_history": new_chat_history})
         # Send the new message to the Savora AI model for processing and return the response
-        savora_response = requests.post(
-            "http://localhost:5000/api/v1/ai/savora",
-            headers={
-                "Mivro-Email": email,
-                "Mivro-Password": request.headers.get("Mivro-Password"),
-            },
-            json={"type": "text", "message": new_message},
-        )
-
-        if savora_response.status_code != 200:
+        try:
+            bot_response = savora_reply(email, "text", new_message)
+        except SchedulerOverloaded:
+            return jsonify({"error": "Savora is busy. Try again later."}), 503
+        except Exception as exc:
             runtime_error(
                 "update_message",
                 "Savora AI failed to process the message.",
-                middleware=savora_response.json(),
+                savora=str(exc),
                 email=email,
             )
-            return (
-                jsonify({"error": "Savora AI failed to process the message."}),
-                savora_response.status_code,
-            )
+            return jsonify({"error": "Savora AI failed to process the message."}), 500
 
-        return savora_response.json()
+        return jsonify({"response": bot_response})
     except Exception as exc:
         runtime_error("update_message", str(exc), email=email)
         return jsonify({"error": str(exc)}), 500
@@ -92,23 +89,10 @@ def delete_message() -> Response:
         return jsonify({"error": "Email and delete message are required."}), 400
 
     try:
-        # Reference the user document by email and retrieve the chat history
-        user_document = user_reference.document(email)
-        chat_history = user_document.get().to_dict().get("chat_history", [])
-
-        # Delete the message from the chat history
-        new_chat_history = [
-            record
-            for record in chat_history
-            if record.get("user_message") != delete_message
-        ]
-
-        # Check if the message was found and deleted
-        if len(new_chat_history) == len(chat_history):
+        # Delete the message from the chat history and check if it was found
+        if not delete_chat_messages(email, delete_message):
             return jsonify({"error": "Message not found in chat history."}), 404
 
-        # Save the updated chat history to the database after deleting the message
-        user_document.update({"chat_history": new_chat_history})
         return jsonify({"message": "Message deleted successfully."})
     except Exception as exc:
         runtime_error("delete_message", str(exc), email=email)
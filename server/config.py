@@ -8,11 +8,150 @@ load_dotenv()
 # Access the environment variables
 FLASK_SECRET_KEY = os.getenv("FLASK_SECRET_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+SHARED_CACHE_ENABLED = os.getenv("SHARED_CACHE_ENABLED", "false").lower() == "true"
+
+# Set the Gemini model used for analysis, recommendations and chat
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# Set the Gemini scheduler limits (Per worker process, calls per second for the rate)
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", 8))
+GEMINI_RATE_LIMIT = float(os.getenv("GEMINI_RATE_LIMIT", 4))
+GEMINI_BURST = 8
+GEMINI_MIN_RATE = 0.2  # Lowest rate after repeated 429 / RESOURCE_EXHAUSTED errors
+# Seconds a call may wait for the scheduler by priority, highest priority first (Longer waits are shed)
+# Batch searches use the lowest priority so they cannot crowd out interactive calls
+GEMINI_QUEUE_TIMEOUTS = {"savora": 30, "lumi": 10, "swapr": 2, "batch": 5}
 
 # Set the default name and photo for a user
 DEFAULT_NAME = "Mivro User"
 DEFAULT_PHOTO = "https://images.pexels.com/photos/756856/pexels-photo-756856.jpeg"
 
-# Set the default timeout values for API requests
-API_TIMEOUT = 60
+# Set the minimum similarity (0-100) for matching an ingredient name to a food icon
+ICON_MATCH_SCORE_CUTOFF = 90
+
+# Set the timeout (in seconds) for Gemini requests (lumi() and swapr() use their shorter deadlines)
 GEMINI_TIMEOUT = 60
+
+# Set the connect and read timeouts (in seconds) for Open Food Facts API requests
+API_CONNECT_TIMEOUT = 3.05
+API_READ_TIMEOUT = 15
+# Set the retry policy for Open Food Facts API requests (Retries are limited to a share of the calls)
+API_MAX_ATTEMPTS = 3
+API_RETRY_BACKOFF = 0.5  # Seconds, doubled for each attempt (with jitter)
+API_RETRY_RATIO = 0.1
+API_MAX_RETRIES = 10
+# Longest an Open Food Facts call can take with its retries (Callers sharing the call wait at most this long)
+API_CALL_TIMEOUT = API_MAX_ATTEMPTS * (API_CONNECT_TIMEOUT + API_READ_TIMEOUT) + (
+    API_RETRY_BACKOFF * (2 ** (API_MAX_ATTEMPTS - 1) - 1)
+)
+# Set the circuit breaker for Open Food Facts (Opens after consecutive failures, retried after the reset timeout)
+API_FAILURE_THRESHOLD = 5
+API_RESET_TIMEOUT = 30
+
+# Set the deadlines (in seconds) for the Gemini calls in the search pipeline
+LUMI_DEADLINE = 20
+SWAPR_DEADLINE = 20
+RECOMMENDATION_DEADLINE = 30  # swapr() followed by an Open Food Facts lookup
+
+# Set the batch size, concurrency and deadline (in seconds) of the batch barcode search
+# Kept well below WORKER_POOL_SIZE and GEMINI_MAX_IN_FLIGHT so a few batches cannot take every thread or Gemini slot
+BATCH_MAX_BARCODES = 50
+BATCH_FETCH_CONCURRENCY = 4  # Open Food Facts lookups in flight per batch
+BATCH_ENRICHMENT_CONCURRENCY = 2  # Gemini calls in flight per batch
+BATCH_ENRICHMENT_DEADLINE = 45
+
+# Set the lifetime (in seconds) of deferred recommendation jobs
+RECOMMENDATION_JOB_TTL = 10 * 60
+
+# Set the number of threads for running upstream calls concurrently
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", 16))
+# Set the keep-alive connection pool size for Open Food Facts (Request threads + worker threads)
+API_POOL_SIZE = int(
+    os.getenv("API_POOL_SIZE", WORKER_POOL_SIZE + int(os.getenv("GUNICORN_THREADS", 8)))
+)
+
+# Set the cache size and lifetimes (in seconds) for Open Food Facts products
+PRODUCT_CACHE_SIZE = 5000
+PRODUCT_CACHE_TTL = 6 * 60 * 60
+PRODUCT_CACHE_STALE_TTL = 24 * 60 * 60
+PRODUCT_NOT_FOUND_TTL = 30 * 60
+
+# Set the cache size and lifetime (in seconds) for Gemini lumi/swapr responses
+GEMINI_CACHE_SIZE = 2000
+GEMINI_CACHE_TTL = 24 * 60 * 60
+
+# Set the size limits (in bytes) for Savora media uploads
+MEDIA_MAX_SIZE = 20 * 1024 * 1024
+REQUEST_MAX_SIZE = (
+    MEDIA_MAX_SIZE + 1024 * 1024
+)  # Media file plus form fields and multipart headers
+MEDIA_SPOOL_SIZE = 2 * 1024 * 1024  # Larger files are spooled to a temporary file
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Set the longest edge (in pixels) and JPEG quality of images after they are downscaled for Gemini
+MEDIA_IMAGE_MAX_SIZE = 1536
+MEDIA_JPEG_QUALITY = 85
+
+# Set the cache size and lifetime (in seconds) for uploaded Gemini files (Uploaded files expire after 48 hours)
+UPLOAD_CACHE_SIZE = 1000
+UPLOAD_CACHE_TTL = 40 * 60 * 60
+
+# Set the cache size and lifetime (in seconds) for verified credentials
+CREDENTIAL_CACHE_SIZE = 10000
+CREDENTIAL_CACHE_TTL = 5 * 60
+
+# Set the default and maximum page sizes for the history endpoints
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+# Set the scan history fields returned by default (Full product data only with fields=full)
+SCAN_SUMMARY_FIELDS = [
+    "product_barcode",
+    "scanned_at",
+    "last_scanned_at",
+    "product_data.product_name",
+    "product_data.brands",
+    "product_data.selected_images",
+    "product_data.primary_score",
+    "product_data.nova_group",
+]
+
+# Set the queue size, batch size and flush interval (in seconds) for background Firestore writes
+WRITE_QUEUE_SIZE = 10000
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_INTERVAL = 2
+# Set the retry policy for failed batch commits (Transient Firestore errors only)
+WRITE_MAX_ATTEMPTS = 3
+WRITE_RETRY_BACKOFF = 0.5  # Seconds, doubled for each attempt (with jitter)
+
+# Set the location of the local product catalog (Built from an Open Food Facts dump with: flask import-catalog)
+CATALOG_PATH = os.getenv(
+    "CATALOG_PATH",
+    os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "data", "catalog.db")
+    ),
+)
+CATALOG_IMPORT_BATCH_SIZE = 10000
+
+# Set the cache size and lifetimes (in seconds) for Open Food Facts text searches
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL = 60 * 60
+SEARCH_NOT_FOUND_TTL = 10 * 60
+# Cached page sizes checked for a larger page that can answer a smaller page request
+SEARCH_CACHE_PAGE_SIZES = [100, 50, 20]
+
+# Set the keys, sync interval (in seconds) and limits of the fuzzy search index over scanned products
+SCAN_SEARCH_KEYS = ["_keywords", "categories", "product_name"]
+SCAN_INDEX_TTL = 10 * 60  # Scans changed since the last sync are read after this
+SCAN_INDEX_SYNC_MARGIN = 60  # Overlap between syncs (Covers clock skew with Firestore)
+SCAN_INDEX_WAIT = 2  # Seconds a search waits for the first build of the index
+# Scans of deleted accounts and histories are only dropped by a full rebuild
+SCAN_INDEX_REBUILD_INTERVAL = 24 * 60 * 60
+# Set the location of the scan index checkpoint (Restored by new and recycled workers instead of reading every scan)
+SCAN_INDEX_PATH = os.getenv(
+    "SCAN_INDEX_PATH",
+    os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "data", "scan_index.json.gz")
+    ),
+)
+SCAN_SEARCH_CANDIDATES = 200  # Products sharing the most trigrams with the keyword
+SCAN_SEARCH_SCORE_CUTOFF = 70  # Minimum token set ratio (0-100)
@@ -1,11 +1,40 @@
-from datetime import datetime
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import firebase_admin
 from firebase_admin import credentials, firestore
+from flask import g, has_app_context
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1.base_query import FieldFilter
 from werkzeug.security import check_password_hash, generate_password_hash
-from fuzzywuzzy import fuzz
-from models import AccountInfo, ScanHistory, SearchHistory
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+from models import AccountInfo, ChatHistory, ScanHistory, SearchHistory
+from metrics import DROPPED_WRITES, track_upstream
+from config import (
+    SCAN_INDEX_PATH,
+    SCAN_INDEX_REBUILD_INTERVAL,
+    SCAN_INDEX_SYNC_MARGIN,
+    SCAN_INDEX_TTL,
+    SCAN_INDEX_WAIT,
+    SCAN_SEARCH_CANDIDATES,
+    SCAN_SEARCH_KEYS,
+    SCAN_SEARCH_SCORE_CUTOFF,
+    WRITE_BATCH_SIZE,
+    WRITE_FLUSH_INTERVAL,
+    WRITE_MAX_ATTEMPTS,
+    WRITE_QUEUE_SIZE,
+    WRITE_RETRY_BACKOFF,
+)
 
 # Initialize the Firebase Admin SDK with the service account key
 firebase_config_path = Path(__file__).parent.parent / "firebase-config.json"
@@ -18,30 +47,422 @@ user_reference = database.collection("users")
 not_found_reference = database.collection("not_found")
 error_reference = database.collection("errors")
 flagged_reference = database.collection("flagged")
+cache_reference = database.collection("cache")
+recommendation_reference = database.collection("recommendations")
+
+
+# Queue for writing analytics, errors and scan history to Firestore in batches (Off the request path)
+# The queue is bounded, so the oldest pending writes are dropped when Firestore cannot keep up
+class WriteBehindQueue:
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.pending = deque(
+            maxlen=max_size
+        )  # (reference, data, merge, create_data) tuples
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped_count = 0
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    # Function for adding a write to the queue (Never blocks the caller)
+    # create_data is only written if the document does not have its first field yet (Merge must list the written fields)
+    def put(self, reference, data: dict, merge=False, create_data: dict = None) -> None:
+        with self.condition:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped_count += 1  # The deque discards the oldest write
+            self.pending.append((reference, data, merge, create_data))
+            self.start()
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    # Function for starting the background writer thread (Restarted lazily in forked workers)
+    def start(self) -> None:
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # Function for flushing the queue when a batch is full or the flush interval has passed
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: len(self.pending) >= self.batch_size, self.flush_interval
+                )
+            self.flush()
+
+    # Function for committing all pending writes as Firestore batched writes
+    def flush(self) -> None:
+        with self.flush_lock:
+            while True:
+                with self.condition:
+                    operations = [
+                        self.pending.popleft()
+                        for _ in range(min(len(self.pending), self.batch_size))
+                    ]
+                    dropped_count, self.dropped_count = self.dropped_count, 0
+                if dropped_count:
+                    DROPPED_WRITES.labels("queue_full").inc(dropped_count)
+                    print(
+                        f"[Database] Write queue full, {dropped_count} write(s) dropped."
+                    )
+                if not operations:
+                    return
+
+                # Printed only, logging through runtime_error would queue another write
+                try:
+                    self.commit(operations)
+                except Exception as exc:
+                    print(
+                        f"[Database] Batch of {len(operations)} write(s) failed: {exc}"
+                    )
+                    if len(operations) == 1:
+                        DROPPED_WRITES.labels("failed").inc()
+                        continue
+
+                    # Write the batch one by one, so only the failing writes are dropped (Already retried as a batch)
+                    for operation in operations:
+                        try:
+                            self.commit([operation], max_attempts=1)
+                        except Exception as exc:
+                            DROPPED_WRITES.labels("failed").inc()
+                            print(
+                                f'[Database] Write to "{operation[0].path}" dropped: {exc}'
+                            )
+
+    # Function for committing writes as one batch (Transient Firestore errors are retried with jittered backoff)
+    def commit(self, operations: list, max_attempts: int = WRITE_MAX_ATTEMPTS) -> None:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                created_paths = self.created_paths(operations)
+                batch = database.batch()
+                for reference, data, merge, create_data in operations:
+                    if create_data and reference.path not in created_paths:
+                        data = {**data, **create_data}
+                        if isinstance(merge, list):
+                            merge = [*merge, *create_data]
+                    batch.set(reference, data, merge=merge)
+                with track_upstream("firestore", "batch.commit"):
+                    batch.commit()
+                return
+            except transient_errors:
+                if attempt == max_attempts:
+                    raise
+            time.sleep(random.uniform(0, WRITE_RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+    # Function for finding the documents of a batch that already have their create-only data (One read for the whole batch)
+    @staticmethod
+    def created_paths(operations: list) -> set:
+        references = {
+            reference.path: (reference, next(iter(create_data)))
+            for reference, _, _, create_data in operations
+            if create_data
+        }
+        if not references:
+            return set()
+
+        created_paths = set()
+        field_paths = sorted({field for _, field in references.values()})
+        with track_upstream("firestore", "batch.get"):
+            snapshots = database.get_all(
+                [reference for reference, _ in references.values()],
+                field_paths=field_paths,
+            )
+            for snapshot in snapshots:
+                field = references[snapshot.reference.path][1]
+                if snapshot.exists and (snapshot.to_dict() or {}).get(field):
+                    created_paths.add(snapshot.reference.path)
+        return created_paths
+
+
+# Firestore errors worth retrying (Overload, timeouts and contention, not invalid writes)
+transient_errors = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+)
+
+write_queue = WriteBehindQueue(
+    max_size=WRITE_QUEUE_SIZE,
+    batch_size=WRITE_BATCH_SIZE,
+    flush_interval=WRITE_FLUSH_INTERVAL,
+)
+atexit.register(write_queue.flush)  # Flush the pending writes on shutdown
+
+
+# Trigram index over the scanned products of every user (Built once, then updated with the scans changed in Firestore)
+# Each sync writes a checkpoint to disk, so new and recycled workers only read the scans changed since then
+# Candidates sharing the most trigrams with the keyword are scored with RapidFuzz, instead of every scan of every user
+class ScanIndex:
+    def __init__(self, search_keys: list, ttl: float, candidate_limit: int):
+        self.search_keys = search_keys
+        self.ttl = ttl
+        self.candidate_limit = candidate_limit
+        self.entries = {}  # Product barcode -> (scan document reference, {search key: text})
+        self.trigrams = defaultdict(set)  # Trigram -> product barcodes
+        self.built_at = None  # UTC time the last full build started
+        self.synced_at = None  # UTC time the last successful sync started
+        self.refreshed_at = None  # Monotonic time the last sync finished
+        self.ready = threading.Event()  # Set once the first build has finished
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()  # Held while the index is being synced
+
+    # Function for splitting a text into the trigrams of its words (Padded, so short words still match)
+    @staticmethod
+    def text_trigrams(text: str) -> set:
+        trigrams = set()
+        for word in text.split():
+            padded_word = f" {word} "
+            trigrams.update(
+                padded_word[index : index + 3] for index in range(len(padded_word) - 2)
+            )
+        return trigrams
+
+    # Function for normalizing the search key values of a product (Lists such as _keywords are joined)
+    def product_texts(self, product_data: dict) -> dict:
+        product_texts = {}
+        for key in self.search_keys:
+            value = product_data.get(key) or ""
+            if isinstance(value, list):
+                value = " ".join(str(item) for item in value)
+            product_texts[key] = default_process(str(value))
+        return product_texts
+
+    # Function for adding a scanned product to the index (One entry per barcode, shared by every user who scanned it)
+    def add(self, product_barcode: str, scan_document_reference, product_data: dict):
+        self.add_texts(
+            product_barcode, scan_document_reference, self.product_texts(product_data)
+        )
 
+    # Function for adding the normalized search key values of a scanned product to the index
+    def add_texts(
+        self, product_barcode: str, scan_document_reference, product_texts: dict
+    ):
+        with self.lock:
+            self.entries[product_barcode] = (scan_document_reference, product_texts)
+            for trigram in self.text_trigrams(" ".join(product_texts.values())):
+                self.trigrams[trigram].add(product_barcode)
+
+    # Function for reading scans from Firestore into the index (Every scan, or only the scans changed since the given time)
+    def load(self, changed_since: datetime = None) -> int:
+        field_paths = [f"product_data.{key}" for key in self.search_keys]
+        query = database.collection_group("scans").select(field_paths)
+        if changed_since:
+            query = query.where(
+                filter=FieldFilter("last_scanned_at", ">=", changed_since)
+            )
+
+        scan_count = 0
+        with track_upstream("firestore", "scans.stream"):
+            for scan_document in query.stream():
+                self.add(
+                    scan_document.id,
+                    scan_document.reference,
+                    scan_document.to_dict().get("product_data", {}),
+                )
+                scan_count += 1
+        return scan_count
+
+    # Function for restoring the index from the checkpoint of an earlier worker (Skipped if it is due for a full rebuild)
+    def restore(self) -> None:
+        try:
+            with gzip.open(SCAN_INDEX_PATH, "rt", encoding="utf-8") as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return
+
+        built_at = datetime.fromisoformat(checkpoint["built_at"])
+        if datetime.now(timezone.utc) - built_at > timedelta(
+            seconds=SCAN_INDEX_REBUILD_INTERVAL
+        ):
+            return
+
+        for product_barcode, (document_path, product_texts) in checkpoint[
+            "entries"
+        ].items():
+            self.add_texts(
+                product_barcode, database.document(document_path), product_texts
+            )
+        self.built_at = built_at
+        self.synced_at = datetime.fromisoformat(checkpoint["synced_at"])
+        print(f"[Database] Scan index restored with {len(self.entries)} scan(s).")
+
+    # Function for writing the index to its checkpoint (Skipped if another worker wrote one during the last sync interval)
+    def save(self) -> None:
+        try:
+            if time.time() - os.stat(SCAN_INDEX_PATH).st_mtime < self.ttl:
+                return
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(SCAN_INDEX_PATH), exist_ok=True)
+
+        with self.lock:
+            entries = {
+                product_barcode: (scan_document_reference.path, product_texts)
+                for product_barcode, (
+                    scan_document_reference,
+                    product_texts,
+                ) in self.entries.items()
+            }
+        checkpoint = {
+            "built_at": self.built_at.isoformat(),
+            "synced_at": self.synced_at.isoformat(),
+            "entries": entries,
+        }
 
-def database_history(email: str, product_barcode: str, product_data: dict) -> None:
-    try:
-        # Check if the user document and scan history for the product barcode exist in Firestore
-        user_document = user_reference.document(email)
-        if user_document.get().exists:
-            user_data = user_document.get().to_dict()
-            if (
-                "scan_history" in user_data
-                and product_barcode in user_data["scan_history"]
+        # Replace the checkpoint in one step so other workers never read a partial file
+        temp_path = f"{SCAN_INDEX_PATH}.{os.getpid()}.tmp"
+        with gzip.open(temp_path, "wt", encoding="utf-8") as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(temp_path, SCAN_INDEX_PATH)
+
+    # Function for syncing the index in a background thread (Restored from the checkpoint or read in full the first time, then only the changed scans)
+    # Deleted scans stay in the index until the next full rebuild, database_search() skips them
+    def sync(self) -> None:
+        sync_started = datetime.now(timezone.utc)
+        try:
+            if self.synced_at is None:
+                self.restore()
+
+            if self.built_at is None or sync_started - self.built_at > timedelta(
+                seconds=SCAN_INDEX_REBUILD_INTERVAL
             ):
-                print(f'[Database] Scan history for "{product_barcode}" exists.')
-                return
+                # Build a new index and swap it in (Drops the scans deleted since the last build)
+                index = ScanIndex(self.search_keys, self.ttl, self.candidate_limit)
+                scan_count = index.load()
+                with self.lock:
+                    self.entries, self.trigrams = index.entries, index.trigrams
+                self.built_at = sync_started
+                print(f"[Database] Scan index built with {scan_count} scan(s).")
+            else:
+                changed_since = self.synced_at - timedelta(
+                    seconds=SCAN_INDEX_SYNC_MARGIN
+                )
+                scan_count = self.load(changed_since)
+                print(f"[Database] Scan index updated with {scan_count} scan(s).")
+            self.synced_at = sync_started
+            self.save()
+        except Exception as exc:
+            print(f"[Database] Scan index sync failed: {exc}")
+        finally:
+            self.refreshed_at = time.monotonic()
+            self.ready.set()
+            self.build_lock.release()
+
+    # Function for starting a background sync once the index is older than its lifetime (Searches never wait for a full build)
+    def ensure_fresh(self) -> None:
+        if self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.ttl:
+            if self.build_lock.acquire(blocking=False):
+                threading.Thread(target=self.sync, daemon=True).start()
+
+    # Function for searching the index (Returns (scan document reference, similarity score) pairs, best match first)
+    def search(self, product_keyword: str, search_keys: list) -> list:
+        # Wait briefly for the first sync (Restoring the checkpoint is quick, a full build may take longer)
+        self.ensure_fresh()
+        self.ready.wait(SCAN_INDEX_WAIT)
+        keyword = default_process(product_keyword)
+        search_keys = [key for key in search_keys if key in self.search_keys]
+
+        # Keep the products sharing the most trigrams with the keyword as candidates
+        with self.lock:
+            trigram_counts = Counter()
+            for trigram in self.text_trigrams(keyword):
+                trigram_counts.update(self.trigrams.get(trigram, ()))
+            candidates = {
+                product_barcode: self.entries[product_barcode]
+                for product_barcode, _ in trigram_counts.most_common(
+                    self.candidate_limit
+                )
+            }
+
+        # Score the candidates by token set ratio for each search key, keeping the best score per product
+        similarity_scores = {}
+        for key in search_keys:
+            key_matches = process.extract(
+                keyword,
+                {
+                    product_barcode: product_texts[key]
+                    for product_barcode, (_, product_texts) in candidates.items()
+                },
+                scorer=fuzz.token_set_ratio,
+                score_cutoff=SCAN_SEARCH_SCORE_CUTOFF,
+                limit=None,
+            )
+            for _, similarity_score, product_barcode in key_matches:
+                similarity_scores[product_barcode] = max(
+                    similarity_score, similarity_scores.get(product_barcode, 0)
+                )
+
+        return [
+            (candidates[product_barcode][0], similarity_score)
+            for product_barcode, similarity_score in sorted(
+                similarity_scores.items(), key=lambda item: item[1], reverse=True
+            )
+        ]
+
+
+scan_index = ScanIndex(
+    search_keys=SCAN_SEARCH_KEYS,
+    ttl=SCAN_INDEX_TTL,
+    candidate_limit=SCAN_SEARCH_CANDIDATES,
+)
+
+
+# Function for loading the user document snapshot once per request (Shared across middleware, gemini, utils and database)
+def load_user_document(email: str):
+    if not has_app_context():
+        return read_user_document(email)
+
+    user_snapshots = g.setdefault("user_snapshots", {})
+    if email not in user_snapshots:
+        user_snapshots[email] = read_user_document(email)
+    return user_snapshots[email]
+
+
+# Function for reading the user document snapshot from Firestore
+def read_user_document(email: str):
+    with track_upstream("firestore", "user.get"):
+        return user_reference.document(email).get()
+
+
+# Function for dropping the loaded user document snapshot after a write (Next load reads from Firestore)
+def invalidate_user_document(email: str) -> None:
+    if has_app_context():
+        g.get("user_snapshots", {}).pop(email, None)
+
+
+# Function for referencing the scan history of a user (One document per scanned barcode)
+def scan_reference(email: str):
+    return user_reference.document(email).collection("scans")
+
+
+# Function for referencing the chat history of a user (One document per chat message)
+def chat_reference(email: str):
+    return user_reference.document(email).collection("chats")
+
 
-        # Store the scan history for the product barcode in Firestore if it does not exist
+def database_history(email: str, product_barcode: str, product_data: dict) -> None:
+    try:
+        # Queue the scan history for the product barcode (scanned_at is kept from the first scan, so history pages stay stable)
         scan_history = ScanHistory(
             product_barcode=product_barcode, product_data=product_data
         )
-        user_document.set(
-            {"scan_history": scan_history.to_dict()}, merge=True
-        )  # Merge the scan history with the existing user document (if any)
+        scan_data = {
+            **scan_history.to_dict(),
+            "last_scanned_at": firestore.SERVER_TIMESTAMP,
+        }
+        scan_document_reference = scan_reference(email).document(product_barcode)
+        write_queue.put(
+            scan_document_reference,
+            scan_data,
+            merge=list(scan_data),
+            create_data={"scanned_at": firestore.SERVER_TIMESTAMP},
+        )
+        # Make the product searchable before the next index rebuild
+        scan_index.add(product_barcode, scan_document_reference, product_data)
 
-        print(f'[Database] Scan history for "{product_barcode}" stored.')
+        print(f'[Database] Scan history for "{product_barcode}" queued.')
     except Exception as exc:
         runtime_error(
             "database_history", str(exc), email=email, product_barcode=product_barcode
@@ -49,51 +470,68 @@ def database_history(email: str, product_barcode: str, product_data: dict) -> No
         return {"error": "Firestore storage error: " + str(exc)}, 500
 
 
-# DEPRECATED
+# Function for adding a recommendation computed after the scan to its scan history
+def update_scan_recommendation(
+    email: str, product_barcode: str, recommendation: dict
+) -> None:
+    try:
+        write_queue.put(
+            scan_reference(email).document(product_barcode),
+            {"product_data": {"recommended_product": recommendation}},
+            merge=True,
+        )
+    except Exception as exc:
+        runtime_error(
+            "update_scan_recommendation",
+            str(exc),
+            email=email,
+            product_barcode=product_barcode,
+        )
+
+
+# Function for storing the state of a deferred recommendation job (Written directly, so any worker can answer the next poll)
+def save_recommendation_job(job_id: str, job_data: dict) -> None:
+    with track_upstream("firestore", "recommendation.set"):
+        recommendation_reference.document(job_id).set(job_data, merge=True)
+
+
+# Function for reading a deferred recommendation job (Returns None if it does not exist or has expired)
+def load_recommendation_job(job_id: str) -> dict:
+    with track_upstream("firestore", "recommendation.get"):
+        job_snapshot = recommendation_reference.document(job_id).get()
+    if not job_snapshot.exists:
+        return None
+
+    job_data = job_snapshot.to_dict()
+    if job_data["expires_at"] <= datetime.now(timezone.utc):
+        return None
+    return job_data
+
+
+# Function for searching the scanned products of every user by keyword (Fuzzy matching over the scan index)
 def database_search(email: str, product_keyword: str, search_keys: list) -> dict:
     try:
-        # Retrieve the scan history of all user documents in Firestore
-        user_stream = user_reference.stream()
-        scan_results = []
-
-        # Compare the product keyword with the search keys in the scan history for each user
-        for user_document in user_stream:
-            user_data = user_document.to_dict()
-            scan_history = user_data.get("scan_history", {})
-
-            # Compare the product keyword with the search keys in the scan history
-            for scan_data in scan_history:
-                for key in search_keys:
-                    # Calculate the similarity score between the product keyword and the scan data by token set ratio method
-                    field_value = str(scan_history[scan_data].get(key, "")).lower()
-                    similarity_score = fuzz.token_set_ratio(
-                        product_keyword.lower(), field_value
-                    )
-                    # Add the scan data to the results if the similarity score is above 70% (arbitrary threshold)
-                    if similarity_score > 70:
-                        scan_results.append(
-                            {
-                                "data": scan_history[scan_data],
-                                "similarity": similarity_score,
-                            }
-                        )
-
-        # Sort the results by similarity (higher similarity = higher relevance)
-        scan_results.sort(key=lambda x: x["similarity"], reverse=True)
-        search_history = SearchHistory(
-            user_searches=product_keyword
-        )  # Store the search history for the product keyword in Firestore
-        user_reference.document(email).set(
+        scan_results = scan_index.search(product_keyword, search_keys)
+
+        # Queue the search history for the product keyword (Merged with the existing user document, if any)
+        search_history = SearchHistory(user_searches=product_keyword)
+        write_queue.put(
+            user_reference.document(email),
             {"search_history": firestore.ArrayUnion([search_history.to_dict()])},
             merge=True,
-        )  # Merge the search history with the existing user document (if any)
+        )
 
         print(
             f'[Database] Found {len(scan_results)} result(s) for "{product_keyword}".'
         )
-        return (
-            scan_results[0]["data"] if scan_results else None
-        )  # Return the most relevant result (if any)
+
+        # Return the most relevant result (Skipping scans that were deleted since the index was built)
+        for scan_document_reference, similarity_score in scan_results:
+            with track_upstream("firestore", "scan.get"):
+                scan_document = scan_document_reference.get()
+            if scan_document.exists:
+                return scan_document.to_dict().get("product_data")
+        return None
     except Exception as exc:
         runtime_error(
             "database_search", str(exc), email=email, product_keyword=product_keyword
@@ -105,11 +543,23 @@ def product_not_found(search_type: str, search_value: str) -> None:
     try:
         # Select the document name based on the search type
         document_name = "barcodes" if search_type == "barcode" else "keywords"
-        not_found_document = not_found_reference.document(document_name)
+        # Store each search value in its own document (Avoids contention on a single document)
+        value_id = hashlib.sha256(search_value.encode()).hexdigest()
+        not_found_document = (
+            not_found_reference.document(document_name)
+            .collection("values")
+            .document(value_id)
+        )
 
-        # Add the search value to the not found list in Firestore
-        not_found_document.set(
-            {"search_values": firestore.ArrayUnion([search_value])}, merge=True
+        # Queue the search value and count how many times it was not found
+        write_queue.put(
+            not_found_document,
+            {
+                "search_value": search_value,
+                "count": firestore.Increment(1),
+                "last_seen": firestore.SERVER_TIMESTAMP,
+            },
+            merge=True,
         )  # Merge the search value with the existing not found document (if any)
 
         print(f'[Database] "{search_value}" -> "{document_name}" not found list.')
@@ -125,8 +575,10 @@ def product_not_found(search_type: str, search_value: str) -> None:
 
 def runtime_error(function_name: str, error_message: str, **kwargs) -> None:
     try:
-        # Select the document name based on the function name
-        error_document = error_reference.document(function_name)
+        # Store each error report in its own document under the function name (Avoids contention during incidents)
+        error_document = (
+            error_reference.document(function_name).collection("reports").document()
+        )
         # Store the error message and timestamp in Firestore for the function
         error_data = {
             "error_message": error_message,
@@ -136,10 +588,8 @@ def runtime_error(function_name: str, error_message: str, **kwargs) -> None:
         if kwargs:
             error_data.update(kwargs)
 
-        # Add the error data to the error reports in Firestore for the function
-        error_document.set(
-            {"error_reports": firestore.ArrayUnion([error_data])}, merge=True
-        )  # Merge the error data with the existing error document (if any)
+        # Queue the error report for the function
+        write_queue.put(error_document, error_data)
 
         print(f'[Database] Error logged for "{function_name}": {error_message}')
     except Exception as exc:
@@ -155,8 +605,7 @@ def runtime_error(function_name: str, error_message: str, **kwargs) -> None:
 def register_user_profile(email: str, password: str) -> None:
     try:
         # Check if the user document already exists in Firestore
-        user_document = user_reference.document(email)
-        if user_document.get().exists:
+        if load_user_document(email).exists:
             return {"error": "User already exists."}, 400
 
         # Create a new user document in Firestore with the account information
@@ -173,7 +622,8 @@ def register_user_profile(email: str, password: str) -> None:
             created_date=created_date,
             created_time=created_time,
         )
-        user_document.set({"account_info": account_info.to_dict()})
+        user_reference.document(email).set({"account_info": account_info.to_dict()})
+        invalidate_user_document(email)
 
         # return {'message': 'Account created successfully.'}
     except Exception as exc:
@@ -185,15 +635,17 @@ def register_user_profile(email: str, password: str) -> None:
 def validate_user_profile(email: str, password: str) -> dict:
     try:
         # Check if the user document exists in Firestore
-        user_document = user_reference.document(email)
-        if not user_document.get().exists:
+        user_snapshot = load_user_document(email)
+        if not user_snapshot.exists:
             return {"error": "User does not exist."}
 
         # Check if the password matches the hashed password stored in Firestore
-        user_data = user_document.get().to_dict()
+        user_data = user_snapshot.to_dict()
         if not check_password_hash(user_data["account_info"]["password"], password):
             return {"error": "Incorrect password."}
 
+        # Move any history still stored in the user document into subcollections
+        migrate_user_history(email, user_data)
         return {"message": "Login successful."}
     except Exception as exc:
         runtime_error("validate_user_profile", str(exc), email=email)
@@ -203,9 +655,10 @@ def validate_user_profile(email: str, password: str) -> dict:
 def remove_user_profile(email: str) -> dict:
     try:
         # Check if the user document exists in Firestore
-        user_document = user_reference.document(email)
-        if user_document.get().exists:
-            user_document.delete()  # Delete the user document from Firestore
+        if load_user_document(email).exists:
+            # Delete the user document and its history subcollections from Firestore
+            database.recursive_delete(user_reference.document(email))
+            invalidate_user_document(email)
             return {"message": "Account deleted successfully."}
         else:
             return {"error": "User document does not exist."}, 404
@@ -221,8 +674,158 @@ def save_health_profile(email: str, health_data: dict) -> dict:
         user_document.set(
             {"health_profile": health_data}, merge=True
         )  # Merge the health profile with the existing user document (if any)
+        invalidate_user_document(email)
 
         return {"message": "Health profile saved successfully."}
     except Exception as exc:
         runtime_error("save_health_profile", str(exc), email=email)
         return {"error": "Firestore storage error: " + str(exc)}, 500
+
+
+# Function for parsing a legacy history timestamp (Returns the epoch if the format does not match)
+def legacy_timestamp(value: str, date_format: str) -> datetime:
+    try:
+        return datetime.strptime(value, date_format)
+    except (TypeError, ValueError):
+        return datetime.fromtimestamp(0)
+
+
+# Function for moving the legacy "scan_history" map and "chat_history" array into subcollections
+def migrate_user_history(email: str, user_data: dict) -> None:
+    if "scan_history" not in user_data and "chat_history" not in user_data:
+        return
+
+    try:
+        bulk_writer = database.bulk_writer()
+        for product_barcode, product_data in user_data.get("scan_history", {}).items():
+            scan_history = ScanHistory(
+                product_barcode=product_barcode, product_data=product_data
+            )
+            scanned_at = legacy_timestamp(
+                f"{product_data.get('search_date')} {product_data.get('search_time')}",
+                "%Y-%m-%d %H:%M:%S",
+            )
+            bulk_writer.set(
+                scan_reference(email).document(product_barcode),
+                {
+                    **scan_history.to_dict(),
+                    "scanned_at": scanned_at,
+                    "last_scanned_at": scanned_at,
+                },
+            )
+
+        # Chat documents get ordered IDs so a repeated migration overwrites instead of duplicating
+        for index, chat_data in enumerate(user_data.get("chat_history", [])):
+            chat_entry = ChatHistory(**chat_data)
+            created_at = legacy_timestamp(chat_entry.timestamp, "%d-%B-%Y %I:%M %p")
+            bulk_writer.set(
+                chat_reference(email).document(f"legacy-{index:06d}"),
+                {**chat_entry.to_dict(), "created_at": created_at},
+            )
+        bulk_writer.close()  # Flush all pending writes before removing the legacy fields
+
+        user_reference.document(email).update(
+            {
+                "scan_history": firestore.DELETE_FIELD,
+                "chat_history": firestore.DELETE_FIELD,
+            }
+        )
+        invalidate_user_document(email)
+
+        print(f'[Database] History for "{email}" migrated to subcollections.')
+    except Exception as exc:
+        runtime_error("migrate_user_history", str(exc), email=email)
+        return {"error": "Firestore migration error: " + str(exc)}, 500
+
+
+# Function for moving the history subcollections to a new email (Used when the email is updated)
+def move_user_history(current_email: str, new_email: str) -> None:
+    bulk_writer = database.bulk_writer()
+    for reference in [scan_reference, chat_reference]:
+        for history_document in reference(current_email).stream():
+            bulk_writer.set(
+                reference(new_email).document(history_document.id),
+                history_document.to_dict(),
+            )
+            bulk_writer.delete(history_document.reference)
+    bulk_writer.close()
+
+
+# Function for reading a page of a history subcollection, newest first (Cursor is the last document ID of the previous page)
+def history_page(
+    reference,
+    order_field: str,
+    page_size: int,
+    cursor: str = None,
+    field_paths: list = None,
+) -> dict:
+    query = reference.order_by(order_field, direction=firestore.Query.DESCENDING)
+    if field_paths:
+        query = query.select(field_paths)  # Project only the requested fields
+
+    if cursor:
+        # Read only the ordering field of the cursor document to resume after it
+        cursor_snapshot = reference.document(cursor).get(field_paths=[order_field])
+        if not cursor_snapshot.exists:
+            raise ValueError("Invalid cursor.")
+        query = query.start_after(cursor_snapshot)
+
+    # Fetch one extra document to know whether another page exists
+    with track_upstream("firestore", "history.query"):
+        history_documents = list(query.limit(page_size + 1).stream())
+    has_more = len(history_documents) > page_size
+    history_documents = history_documents[:page_size]
+
+    return {
+        "items": [
+            {"id": history_document.id, **history_document.to_dict()}
+            for history_document in history_documents
+        ],
+        "next_cursor": history_documents[-1].id if has_more else None,
+    }
+
+
+# Function for reading a page of an array field in the user document, newest first
+# The cursor is the position of the next entry counted from the oldest one, so new entries (appended at the end) do not shift it
+def array_page(email: str, field: str, page_size: int, cursor: str = None) -> dict:
+    if cursor and not cursor.isdigit():
+        raise ValueError("Invalid cursor.")
+
+    # Read only the requested field instead of the whole user document
+    with track_upstream("firestore", "history.get"):
+        user_snapshot = user_reference.document(email).get(field_paths=[field])
+    values = (user_snapshot.to_dict() or {}).get(field, [])
+
+    end = len(values) if cursor is None else min(int(cursor), len(values))
+    start = max(0, end - page_size)
+    return {
+        "items": values[start:end][::-1],
+        "next_cursor": str(start) if start > 0 else None,
+    }
+
+
+# Function for deleting the scan or chat history subcollection of a user
+def clear_user_history(email: str, history_field: str) -> None:
+    history_references = {
+        "scan_history": scan_reference,
+        "chat_history": chat_reference,
+    }
+    if history_field in history_references:
+        database.recursive_delete(history_references[history_field](email))
+
+
+# Function for deleting the chat messages that match the user message (Returns the number deleted)
+def delete_chat_messages(email: str, user_message: str) -> int:
+    matching_messages = chat_reference(email).where(
+        filter=FieldFilter("user_message", "==", user_message)
+    )
+
+    batch = database.batch()
+    deleted_count = 0
+    for chat_document in matching_messages.stream():
+        batch.delete(chat_document.reference)
+        deleted_count += 1
+
+    if deleted_count:
+        batch.commit()
+    return deleted_count
@@ -1,13 +1,40 @@
 import os
 import json
+import hashlib
+import tempfile
 from google import genai
 from google.genai import types
-from config import GEMINI_API_KEY
-from flask import Blueprint, Response, jsonify, request
+from config import (
+    GEMINI_API_KEY,
+    GEMINI_CACHE_SIZE,
+    GEMINI_CACHE_TTL,
+    GEMINI_BURST,
+    GEMINI_MAX_IN_FLIGHT,
+    GEMINI_MIN_RATE,
+    GEMINI_MODEL,
+    GEMINI_QUEUE_TIMEOUTS,
+    GEMINI_RATE_LIMIT,
+    GEMINI_TIMEOUT,
+    LUMI_DEADLINE,
+    MEDIA_CHUNK_SIZE,
+    MEDIA_MAX_SIZE,
+    MEDIA_SPOOL_SIZE,
+    SWAPR_DEADLINE,
+    UPLOAD_CACHE_SIZE,
+    UPLOAD_CACHE_TTL,
+)
+from cache import TieredCache
+from metrics import track_upstream
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 from models import ChatHistory
 from utils import chat_history, health_profile
 from database import runtime_error
+from middleware import size_error_handler
+from media import prepare_image
+from workers import SingleFlight
+from upstream import CallScheduler, SchedulerOverloaded
 
 # Blueprint for the ai routes
 ai_blueprint = Blueprint("ai", __name__)
@@ -17,8 +44,11 @@ if GEMINI_API_KEY:
 else:
     print("GEMINI_API_KEY is not set.")
 
-# Initialize the Gemini client with API key
-client = genai.Client(api_key=GEMINI_API_KEY)
+# Initialize the Gemini client with API key (Every request times out, so an abandoned call never holds its thread and scheduler slot)
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=types.HttpOptions(timeout=GEMINI_TIMEOUT * 1000),
+)
 
 # Safety settings to block harmful content (BLOCK_NONE is set to ignore triggers in product data for accurate context processing)
 # Thresholds: https://ai.google.dev/gemini-api/docs/safety-settings
@@ -45,8 +75,68 @@ swapr_instructions = load_instructions("instructions/swapr_instructions.md")
 savora_instructions = load_instructions("instructions/savora_instructions.md")
 
 
+# Cache the lumi() and swapr() responses by a hash of the request content
+response_cache = TieredCache(
+    "gemini", max_size=GEMINI_CACHE_SIZE, ttl=GEMINI_CACHE_TTL, shared=True
+)
+
+
+# Schedule every Gemini generation (Savora chat first, then lumi, then swapr, which is shed first under pressure)
+gemini_scheduler = CallScheduler(
+    "gemini",
+    max_in_flight=GEMINI_MAX_IN_FLIGHT,
+    rate=GEMINI_RATE_LIMIT,
+    burst=GEMINI_BURST,
+    min_rate=GEMINI_MIN_RATE,
+    queue_timeouts=GEMINI_QUEUE_TIMEOUTS,
+)
+
+# Share one Gemini call between concurrent requests with identical content
+gemini_flight = SingleFlight("gemini")
+
+# Cache the uploaded Gemini file handles by content hash (Shorter than the 48 hour lifetime of uploaded files)
+upload_cache = TieredCache(
+    "uploads", max_size=UPLOAD_CACHE_SIZE, ttl=UPLOAD_CACHE_TTL, shared=True
+)
+
+# Allowed media file types for Savora (File extension -> MIME type)
+media_types = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".pdf": "application/pdf",
+    ".txt": "text/plain",
+}
+
+
+# Function for building a stable cache key from the model, system instructions and message content
+# (Editing an instruction file changes the key, so stale responses are never reused)
+def response_key(instructions: str, *contents) -> str:
+    canonical_content = json.dumps(
+        [GEMINI_MODEL, instructions, *contents],
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical_content.encode()).hexdigest()
+
+
+# Fallback response for lumi() (Empty structure for frontend compatibility)
+def lumi_fallback() -> dict:
+    return {
+        "positive_nutrient": [],
+        "negative_nutrient": [],
+        "ingredient_warnings": [],
+    }
+
+
+# Fallback response for swapr()
+def swapr_fallback() -> dict:
+    return {"product_name": "No recommendation available"}
+
+
 @ai_blueprint.route("/lumi", methods=["POST"])
-def lumi(product_data: dict) -> dict:
+def lumi(product_data: dict, priority: str = "lumi") -> dict:
     try:
         # Get email value from the request headers
         email = request.headers.get("Mivro-Email")
@@ -55,133 +145,278 @@ def lumi(product_data: dict) -> dict:
 
         # Retrieve the user's health profile from Firestore (if any)
         health_data = health_profile(email)
+
         # Send the user's health profile and product data to the Gemini model
-        user_message = f"Health Profile: {health_data}\nProduct Data: {product_data}"
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=user_message,
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                system_instruction=lumi_instructions,
-                safety_settings=safety_settings,
+        def analyse() -> dict:
+            user_message = (
+                f"Health Profile: {health_data}\nProduct Data: {product_data}"
+            )
+            with gemini_scheduler.slot(priority), track_upstream("gemini", "lumi"):
+                response = client.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=user_message,
+                    config=types.GenerateContentConfig(
+                        response_mime_type="application/json",
+                        system_instruction=lumi_instructions,
+                        safety_settings=safety_settings,
+                        # Give up once the search pipeline stops waiting for the analysis
+                        http_options=types.HttpOptions(timeout=LUMI_DEADLINE * 1000),
+                    ),
+                )
+            return json.loads(response.text)
+
+        # Reuse the analysis for an identical health profile and product data (if cached)
+        cache_key = response_key(lumi_instructions, product_data, health_data)
+        return response_cache.fetch(
+            cache_key,
+            lambda: gemini_flight.run(
+                cache_key, analyse, GEMINI_QUEUE_TIMEOUTS[priority] + LUMI_DEADLINE
             ),
         )
-
-        return json.loads(response.text)
+    except (SchedulerOverloaded, TimeoutError) as exc:
+        # Shed calls and callers timed out waiting on an identical call get the fallback
+        print(f"[Gemini] {exc}")
+        return lumi_fallback()
     except Exception as exc:
         runtime_error("lumi", str(exc), email=email)
-        # Return proper empty structure for frontend compatibility
-        return {
-            "positive_nutrient": [],
-            "negative_nutrient": [],
-            "ingredient_warnings": [],
-        }
+        return lumi_fallback()
 
 
 @ai_blueprint.route("/swapr", methods=["POST"])
-def swapr(email: str, product_data: dict) -> dict:
+def swapr(email: str, product_data: dict, priority: str = "swapr") -> dict:
     try:
         # Send the product data to the Gemini model
-        user_message = f"Product Data: {product_data}"
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=user_message,
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                system_instruction=swapr_instructions,
-                safety_settings=safety_settings,
+        def recommend() -> dict:
+            user_message = f"Product Data: {product_data}"
+            with gemini_scheduler.slot(priority), track_upstream("gemini", "swapr"):
+                response = client.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=user_message,
+                    config=types.GenerateContentConfig(
+                        response_mime_type="application/json",
+                        system_instruction=swapr_instructions,
+                        safety_settings=safety_settings,
+                        # Give up once the search pipeline stops waiting for the recommendation
+                        http_options=types.HttpOptions(timeout=SWAPR_DEADLINE * 1000),
+                    ),
+                )
+
+            # Return recommended product name
+            filtered_response = response.text.replace('"', "").replace("**", "").strip()
+            return {"product_name": filtered_response}
+
+        # Reuse the recommendation for identical product data (if cached)
+        cache_key = response_key(swapr_instructions, product_data)
+        return response_cache.fetch(
+            cache_key,
+            lambda: gemini_flight.run(
+                cache_key, recommend, GEMINI_QUEUE_TIMEOUTS[priority] + SWAPR_DEADLINE
             ),
         )
-
-        # Return recommended product name
-        filtered_response = response.text.replace('"', "").replace("**", "").strip()
-        return {"product_name": filtered_response}
+    except (SchedulerOverloaded, TimeoutError) as exc:
+        print(f"[Gemini] {exc}")
+        return swapr_fallback()
     except Exception as exc:
         runtime_error("swapr", str(exc), email=email)
-        return {"product_name": "No recommendation available"}
+        return swapr_fallback()
 
 
-@ai_blueprint.route("/savora", methods=["POST"])
-def savora() -> Response:
-    try:
-        # Check if the request contains a file upload (multipart/form-data)
-        if "media" in request.files:
-            user_email = request.headers.get("Mivro-Email")
-            message_type = request.form.get("type")
-            user_message = request.form.get("message")
-            media_file = request.files.get("media")
-        else:
-            # Otherwise, expect JSON input (application/json)
-            user_email = request.headers.get("Mivro-Email")
-            message_type = request.json.get("type")
-            user_message = request.json.get("message")
-            media_file = None
+# Function for reading the Savora message from the request (Multipart form data with a media file, or JSON)
+def savora_request() -> tuple:
+    if "media" in request.files:
+        return (
+            request.form.get("type"),
+            request.form.get("message"),
+            request.files.get("media"),
+        )
+    # Otherwise, expect JSON input (application/json)
+    return request.json.get("type"), request.json.get("message"), None
 
-        if not user_email or not message_type or not user_message:
-            return (
-                jsonify({"error": "Email, message type, and message are required."}),
-                400,
-            )
 
-        # Send the user's message to the Gemini model
-        if message_type == "text":
-            bot_response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=user_message,
-                config=types.GenerateContentConfig(
-                    system_instruction=savora_instructions,
-                    safety_settings=safety_settings,
-                ),
+# Function for building the Gemini contents of a Savora message (Raises ValueError for an invalid message)
+def savora_contents(message_type: str, user_message: str, media_file):
+    if message_type == "text":
+        return user_message
+
+    # Upload the media file to the Gemini model and send it with the message
+    if message_type == "media":
+        if not media_file or media_file.filename == "":
+            raise ValueError("No file selected.")
+
+        # Check if the media file type is allowed
+        mime_type = media_types.get(os.path.splitext(media_file.filename)[1].lower())
+        if not mime_type:
+            raise ValueError(
+                "Invalid file type. Allowed types: PNG, JPG, JPEG, PDF, TXT."
             )
 
-        # Upload the media file to the Gemini model and generate content
-        elif message_type == "media":
-            if not media_file or media_file.filename == "":
-                return jsonify({"error": "No file selected."}), 400
+        return [upload_media(media_file, mime_type), "\n\n", user_message]
 
-            # Check if the media file type is allowed
-            if not media_file.filename.endswith(
-                (".png", ".jpg", ".jpeg", ".pdf", ".txt")
-            ):
-                return (
-                    jsonify(
-                        {
-                            "error": "Invalid file type. Allowed types: PNG, JPG, JPEG, PDF, TXT."
-                        }
-                    ),
-                    400,
+    raise ValueError("Invalid message type.")
+
+
+# Function for copying the media file into a spooled temporary file while hashing it (Kept in memory up to MEDIA_SPOOL_SIZE)
+def spool_media(media_file) -> tuple:
+    spooled_file = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_SIZE)
+    content_hash = hashlib.sha256()
+    file_size = 0
+
+    while chunk := media_file.stream.read(MEDIA_CHUNK_SIZE):
+        file_size += len(chunk)
+        if file_size > MEDIA_MAX_SIZE:
+            spooled_file.close()
+            raise RequestEntityTooLarge()
+        content_hash.update(chunk)
+        spooled_file.write(chunk)
+
+    spooled_file.seek(0)
+    return spooled_file, content_hash.hexdigest()
+
+
+# Function for uploading the media file to the Gemini client (The same content is uploaded only once)
+def upload_media(media_file, mime_type: str) -> types.Part:
+    spooled_file, content_hash = spool_media(media_file)
+    with spooled_file:
+
+        def upload() -> dict:
+            # Downscale and re-encode images before uploading them (Only on a cache miss)
+            upload_file, upload_type = spooled_file, mime_type
+            if mime_type.startswith("image/"):
+                upload_file, upload_type = prepare_image(spooled_file, mime_type)
+
+            with track_upstream("gemini", "files.upload"):
+                uploaded_file = client.files.upload(
+                    file=upload_file,
+                    config={
+                        "mime_type": upload_type,
+                        "display_name": secure_filename(media_file.filename),
+                    },
                 )
+            return {"uri": uploaded_file.uri, "mime_type": uploaded_file.mime_type}
 
-            # Save the media file to a temporary location
-            file_name = secure_filename(media_file.filename)
-            temp_path = os.path.join(file_name)
-            media_file.save(temp_path)
-
-            # Upload the media file to the Gemini client
-            uploaded_file = client.files.upload(path=temp_path)
-            bot_response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=[uploaded_file, "\n\n", user_message],
-                config=types.GenerateContentConfig(
-                    system_instruction=savora_instructions,
-                    safety_settings=safety_settings,
-                ),
-            )
+        uploaded_file = upload_cache.fetch(f"{content_hash}:{mime_type}", upload)
+
+    return types.Part.from_uri(
+        file_uri=uploaded_file["uri"], mime_type=uploaded_file["mime_type"]
+    )
+
+
+# Function for building the Gemini generation config for Savora
+def savora_config() -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        system_instruction=savora_instructions,
+        safety_settings=safety_settings,
+    )
+
+
+# Function for sending a Savora message to the Gemini model and storing the chat history (Used by the savora and update-message routes)
+def savora_reply(
+    user_email: str, message_type: str, user_message: str, media_file=None
+) -> str:
+    # Send the user's message (and media file, if any) to the Gemini model
+    contents = savora_contents(message_type, user_message, media_file)
+    with gemini_scheduler.slot("savora"), track_upstream("gemini", "savora"):
+        bot_response = client.models.generate_content(
+            model=GEMINI_MODEL, contents=contents, config=savora_config()
+        )
+
+    # Store the chat history for the user's email in Firestore
+    chat_entry = ChatHistory(
+        user_message=user_message,
+        bot_response=bot_response.text,
+        message_type=message_type,
+    )
+    chat_history(user_email, chat_entry)
+    return bot_response.text
 
-            # Delete the temporary file after processing
-            os.remove(temp_path)
-        else:
-            return jsonify({"error": "Invalid message type."}), 400
+
+# Function for formatting a Server-Sent Event
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Function for streaming the Savora response as Server-Sent Events (Chat history is stored once the stream completes)
+def stream_savora(user_email: str, message_type: str, user_message: str, contents):
+    try:
+        response_parts = []
+        with (
+            gemini_scheduler.slot("savora"),
+            track_upstream("gemini", "savora.stream"),
+        ):
+            for chunk in client.models.generate_content_stream(
+                model=GEMINI_MODEL, contents=contents, config=savora_config()
+            ):
+                if chunk.text:
+                    response_parts.append(chunk.text)
+                    yield sse_event("message", {"text": chunk.text})
 
         # Store the chat history for the user's email in Firestore
+        bot_response = "".join(response_parts)
         chat_entry = ChatHistory(
             user_message=user_message,
-            bot_response=bot_response.text,
+            bot_response=bot_response,
             message_type=message_type,
         )
         chat_history(user_email, chat_entry)
 
-        return jsonify({"response": bot_response.text})
+        yield sse_event("done", {"response": bot_response})
+    except SchedulerOverloaded:
+        yield sse_event("error", {"error": "Savora is busy. Try again later."})
+    except Exception as exc:
+        runtime_error("stream_savora", str(exc), email=user_email)
+        yield sse_event("error", {"error": str(exc)})
+
+
+@ai_blueprint.route("/savora", methods=["POST"])
+def savora() -> Response:
+    # Get email value from the request headers
+    user_email = request.headers.get("Mivro-Email")
+    try:
+        message_type, user_message, media_file = savora_request()
+        if not user_email or not message_type or not user_message:
+            return (
+                jsonify({"error": "Email, message type, and message are required."}),
+                400,
+            )
+
+        bot_response = savora_reply(user_email, message_type, user_message, media_file)
+        return jsonify({"response": bot_response})
+    except RequestEntityTooLarge as exc:
+        return size_error_handler(exc)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    except SchedulerOverloaded:
+        return jsonify({"error": "Savora is busy. Try again later."}), 503
     except Exception as exc:
         runtime_error("savora", str(exc), email=user_email)
         return jsonify({"error": str(exc)}), 500
+
+
+@ai_blueprint.route("/savora/stream", methods=["POST"])
+def savora_stream() -> Response:
+    # Get email value from the request headers
+    user_email = request.headers.get("Mivro-Email")
+    try:
+        message_type, user_message, media_file = savora_request()
+        if not user_email or not message_type or not user_message:
+            return (
+                jsonify({"error": "Email, message type, and message are required."}),
+                400,
+            )
+
+        # Send the response text as it is generated (Same request body as /savora)
+        contents = savora_contents(message_type, user_message, media_file)
+        return Response(
+            stream_with_context(
+                stream_savora(user_email, message_type, user_message, contents)
+            ),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    except RequestEntityTooLarge as exc:
+        return size_error_handler(exc)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    except Exception as exc:
+        runtime_error("savora_stream", str(exc), email=user_email)
+        return jsonify({"error": str(exc)}), 500
@@ -1,3 +1,10 @@
+import re
+import unicodedata
+
+from rapidfuzz import fuzz, process
+from config import ICON_MATCH_SCORE_CUTOFF
+
+
 # Function for mapping the additive number to a human-readable name (Uses additive_names.json)
 def additive_name(additives_tags: list, additives_data: dict) -> list:
     return [additives_data.get(additive, "Unknown") for additive in additives_tags]
@@ -76,9 +83,72 @@ def primary_score(product_data: dict) -> dict:
         }
 
 
-# Function for getting the icon based on the category map (Used in utils.py)
-def food_icon(name: str, category_map: dict) -> str:
+# Function for turning a plural word into its singular form (Only needs to agree for names and category items)
+def singular_word(word: str) -> str:
+    if len(word) <= 3 or word.endswith(("ss", "us", "is")):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("oes", "ses", "xes", "ches", "shes")):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+# Function for normalizing an ingredient or nutrient name (Case, accents, punctuation and plurals are ignored)
+def icon_key(name: str) -> str:
+    decomposed_name = unicodedata.normalize("NFKD", name)
+    stripped_name = "".join(
+        char for char in decomposed_name if not unicodedata.combining(char)
+    )
+    words = re.sub(r"[^a-z0-9]+", " ", stripped_name.casefold()).split()
+    return " ".join(singular_word(word) for word in words)
+
+
+# Function for compiling the category map into a reverse lookup of normalized names to icons (Used in utils.py)
+def icon_index(category_map: dict) -> dict:
+    food_icons = {}
     for category, items in category_map.items():
-        if name in items:
-            return category.lower().replace(" ", "-")
+        icon = category.lower().replace(" ", "-")
+        for name in [category.replace("-", " "), *items]:
+            food_icons.setdefault(icon_key(name), icon)
+    return food_icons
+
+
+# Function for checking if a word names a food of the icon index (A known word, or a compound ending in one, e.g. "Peanut" for "Nut")
+def food_word(word: str, food_icons: dict) -> bool:
+    return any(
+        icon_name == word or (len(icon_name) > 2 and word.endswith(icon_name))
+        for icon_name in food_icons
+        if " " not in icon_name
+    )
+
+
+# Function for getting the icon of an ingredient or nutrient name from the compiled icon index (Used in utils.py)
+def food_icon(name: str, food_icons: dict) -> str:
+    name_key = icon_key(name)
+    if name_key in food_icons:
+        return food_icons[name_key]
+
+    # Match misspelled or slightly different names (e.g. "Flavoring" for "Flavouring")
+    if name_key:
+        name_match = process.extractOne(
+            name_key,
+            food_icons.keys(),
+            scorer=fuzz.ratio,
+            score_cutoff=ICON_MATCH_SCORE_CUTOFF,
+        )
+        if name_match:
+            return food_icons[name_match[0]]
+
+    # Match the last word of the name if the words before it only describe it (e.g. "Skimmed Milk" for "Milk", not "Peanut Butter")
+    words = name_key.split()
+    if (
+        len(words) > 1
+        and words[-1] in food_icons
+        and not any(food_word(word, food_icons) for word in words[:-1])
+    ):
+        return food_icons[words[-1]]
+
     return name.lower().replace(" ", "-")
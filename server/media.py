@@ -0,0 +1,43 @@
+import io
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+from config import MEDIA_IMAGE_MAX_SIZE, MEDIA_JPEG_QUALITY
+
+
+# Function for checking if an image has transparent pixels (Kept as PNG, JPEG has no alpha channel)
+def has_transparency(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (
+        image.mode == "P" and "transparency" in image.info
+    )
+
+
+# Function for downscaling and re-encoding an image before it is uploaded to Gemini (Raises ValueError for invalid or oversized images)
+# Returns the original file if the re-encoded image is not smaller
+def prepare_image(image_file, mime_type: str) -> tuple:
+    max_size = (MEDIA_IMAGE_MAX_SIZE, MEDIA_IMAGE_MAX_SIZE)
+    try:
+        with Image.open(image_file) as image:
+            # Let the JPEG decoder downscale while decoding (Much faster for large photos)
+            image.draft("RGB", max_size)
+            image = ImageOps.exif_transpose(image)  # Rotate phone photos upright
+            image.thumbnail(max_size, Image.Resampling.LANCZOS)
+
+            prepared_file = io.BytesIO()
+            if has_transparency(image):
+                image.save(prepared_file, "PNG", optimize=True)
+                prepared_type = "image/png"
+            else:
+                image.convert("RGB").save(
+                    prepared_file, "JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True
+                )
+                prepared_type = "image/jpeg"
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as exc:
+        raise ValueError("Invalid image file.") from exc
+
+    image_file.seek(0, io.SEEK_END)
+    if prepared_file.tell() >= image_file.tell():
+        image_file.seek(0)
+        return image_file, mime_type
+
+    prepared_file.seek(0)
+    return prepared_file, prepared_type
@@ -1,15 +1,121 @@
-from prometheus_client import Counter, generate_latest, CONTENT_TYPE_LATEST
-from flask import Blueprint, Response
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from flask import Blueprint, Response, g, request
 
 # Blueprint for the metrics route
 metrics_blueprint = Blueprint("metrics", __name__)
 
+# Histogram buckets (in seconds) from cache hits up to slow Gemini generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
 # Define Prometheus metrics
 REQUEST_COUNT = Counter(
     "request_count", "Total number of requests", ["method", "endpoint", "http_status"]
 )
+REQUEST_LATENCY = Histogram(
+    "request_latency_seconds",
+    "Request latency in seconds",
+    ["method", "endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "requests_in_progress",
+    "Number of requests being processed",
+    ["method", "endpoint"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_latency_seconds",
+    "Latency of upstream calls (Open Food Facts, Gemini, Firestore) in seconds",
+    ["service", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    "upstream_errors", "Total number of failed upstream calls", ["service", "operation"]
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries",
+    "Total number of retried upstream calls",
+    ["service", "operation"],
+)
+SHED_CALLS = Counter(
+    "shed_calls",
+    "Total number of upstream calls shed by the scheduler",
+    ["service", "priority"],
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests", "Total number of cache lookups by result", ["cache", "result"]
+)
+DROPPED_WRITES = Counter(
+    "dropped_writes",
+    "Total number of queued Firestore writes that were dropped",
+    ["reason"],
+)
+COALESCED_CALLS = Counter(
+    "coalesced_calls",
+    "Total number of upstream calls shared with an identical in-flight call",
+    ["group"],
+)
+
+
+# Function for starting the request timer (Registered as a before_request hook)
+def start_request_timer() -> None:
+    g.request_start = time.perf_counter()
+    # Use the route pattern (not the raw path) to keep the label cardinality bounded
+    g.request_endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS_IN_PROGRESS.labels(request.method, g.request_endpoint).inc()
+
+
+# Function for recording the request count and latency (Registered as an after_request hook)
+def record_request_metrics(response: Response) -> Response:
+    if "request_start" in g:
+        REQUEST_COUNT.labels(
+            request.method, g.request_endpoint, response.status_code
+        ).inc()
+        REQUEST_LATENCY.labels(request.method, g.request_endpoint).observe(
+            time.perf_counter() - g.request_start
+        )
+    return response
+
+
+# Function for closing the in-progress request (Registered as a teardown_request hook)
+def finish_request_timer(exception=None) -> None:
+    if "request_start" in g:
+        REQUESTS_IN_PROGRESS.labels(request.method, g.request_endpoint).dec()
+
+
+# Context manager for timing an upstream call and counting its failures
+@contextmanager
+def track_upstream(service: str, operation: str):
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        UPSTREAM_ERRORS.labels(service, operation).inc()
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(service, operation).observe(
+            time.perf_counter() - start_time
+        )
 
 
 @metrics_blueprint.route("/metrics")
 def metrics() -> Response:
+    # Aggregate the metrics of every Gunicorn worker when running in multiprocess mode
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
     return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
@@ -1,5 +1,37 @@
+import hashlib
+import hmac
+import secrets
+
 from flask import Response, jsonify, request
-from database import runtime_error, validate_user_profile
+from database import load_user_document, runtime_error, validate_user_profile
+from cache import TieredCache
+from config import CREDENTIAL_CACHE_SIZE, CREDENTIAL_CACHE_TTL, MEDIA_MAX_SIZE
+
+# Cache the verified credentials by email (In-process only, passwords are never stored in plain text)
+# Each entry keeps the stored password hash it was verified against, so a changed or deleted account is noticed by every worker
+credential_cache = TieredCache(
+    "credentials", max_size=CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL
+)
+# Per-process key for the password digests (Cached digests are useless outside this process)
+credential_key = secrets.token_bytes(32)
+
+
+# Function for computing a keyed digest of the password
+def credential_digest(password: str) -> str:
+    return hmac.new(credential_key, password.encode(), hashlib.sha256).hexdigest()
+
+
+# Function for removing the cached credentials after an email update or account deletion (Frees the entry in this process)
+def invalidate_credentials(email: str) -> None:
+    credential_cache.delete(email)
+
+
+# Function for reading the stored password hash of a user (None if the account no longer exists)
+def stored_password_hash(email: str) -> str:
+    user_snapshot = load_user_document(email)
+    if not user_snapshot.exists:
+        return None
+    return user_snapshot.to_dict()["account_info"]["password"]
 
 
 def auth_handler() -> Response:
@@ -37,12 +69,24 @@ def auth_handler() -> Response:
         return jsonify({"error": "Email and password are required."}), 401
 
     try:
+        # Skip the password hash check for recently verified credentials (If the stored password hash is unchanged)
+        digest = credential_digest(password)
+        found, cached_credentials, _ = credential_cache.get(email)
+        if found:
+            cached_digest, password_hash = cached_credentials
+            if hmac.compare_digest(
+                cached_digest, digest
+            ) and password_hash == stored_password_hash(email):
+                return None
+
         # Validate the user profile using the email and password
         result = validate_user_profile(email, password)
         if "error" in result:
             # Set the status code based on the error message
             status_code = 401 if "Incorrect password." in result["error"] else 404
             return jsonify(result), status_code
+
+        credential_cache.set(email, (digest, stored_password_hash(email)))
     except Exception as exc:
         runtime_error("auth_handler", str(exc), email=email)
         return jsonify({"error": str(exc)}), 500
@@ -50,3 +94,9 @@ def auth_handler() -> Response:
 
 def error_handler(exception) -> Response:
     return jsonify({"message": "Error with request path. Check and try again."}), 500
+
+
+# Error handler for request bodies over MAX_CONTENT_LENGTH (Rejected before the body is read)
+def size_error_handler(exception) -> Response:
+    max_size = MEDIA_MAX_SIZE // (1024 * 1024)
+    return jsonify({"error": f"File too large. Maximum size: {max_size} MB."}), 413
@@ -78,7 +78,10 @@ class ScanHistory:
         self.product_data = product_data
 
     def to_dict(self) -> dict:
-        return {self.product_barcode: self.product_data}
+        return {
+            "product_barcode": self.product_barcode,
+            "product_data": self.product_data,
+        }
 
 
 # Model for user search history
@@ -1,20 +1,72 @@
+import json
+import secrets
 import sys
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone
+from functools import partial
 
-from flask import Blueprint, Response, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from openfoodfacts import API, APIVersion, Country, Environment, Flavor
+from openfoodfacts.utils import http_session
 from utils import (
     filter_additive,
     filter_data,
     filter_image,
     filter_ingredient,
+    normalize_query,
     product_schema,
     additive_names,
 )
 from mapping import additive_name, nova_name, primary_score
-from gemini import lumi, swapr
-from database import database_history, product_not_found, runtime_error
-from config import API_TIMEOUT
+from gemini import lumi, lumi_fallback, swapr, swapr_fallback
+from database import (
+    database_history,
+    database_search,
+    product_not_found,
+    runtime_error,
+    load_recommendation_job,
+    save_recommendation_job,
+    update_scan_recommendation,
+)
+from workers import SingleFlight, future_result, run_bounded, submit, wait_for
+from cache import TieredCache
+from catalog import find_product, search_catalog
+from upstream import (
+    CircuitBreaker,
+    RetryBudget,
+    TimeoutAdapter,
+    UpstreamClient,
+    UpstreamUnavailable,
+)
+from config import (
+    API_CALL_TIMEOUT,
+    API_CONNECT_TIMEOUT,
+    API_FAILURE_THRESHOLD,
+    API_MAX_ATTEMPTS,
+    API_MAX_RETRIES,
+    API_POOL_SIZE,
+    API_READ_TIMEOUT,
+    API_RESET_TIMEOUT,
+    API_RETRY_BACKOFF,
+    API_RETRY_RATIO,
+    BATCH_ENRICHMENT_CONCURRENCY,
+    BATCH_ENRICHMENT_DEADLINE,
+    BATCH_FETCH_CONCURRENCY,
+    BATCH_MAX_BARCODES,
+    LUMI_DEADLINE,
+    PRODUCT_CACHE_SIZE,
+    PRODUCT_CACHE_STALE_TTL,
+    PRODUCT_CACHE_TTL,
+    PRODUCT_NOT_FOUND_TTL,
+    RECOMMENDATION_DEADLINE,
+    RECOMMENDATION_JOB_TTL,
+    SCAN_SEARCH_KEYS,
+    SEARCH_CACHE_PAGE_SIZES,
+    SEARCH_CACHE_SIZE,
+    SEARCH_CACHE_TTL,
+    SEARCH_NOT_FOUND_TTL,
+    SWAPR_DEADLINE,
+)
 
 # Blueprint for the search routes
 search_blueprint = Blueprint("search", __name__)
@@ -25,10 +77,342 @@ api = API(
     flavor=Flavor.off,
     version=APIVersion.v2,
     environment=Environment.org,
-    timeout=API_TIMEOUT,
+    timeout=API_READ_TIMEOUT,
+)
+# Reuse keep-alive connections sized for every thread that calls the Open Food Facts API (Shared by the API client)
+openfoodfacts_adapter = TimeoutAdapter(
+    API_CONNECT_TIMEOUT,
+    API_READ_TIMEOUT,
+    pool_connections=2,
+    pool_maxsize=API_POOL_SIZE,
+)
+http_session.mount("https://", openfoodfacts_adapter)
+http_session.mount("http://", openfoodfacts_adapter)
+# Retry failed Open Food Facts calls within a budget and fail fast while it is down (Stale cached data is served meanwhile)
+openfoodfacts_client = UpstreamClient(
+    "openfoodfacts",
+    breaker=CircuitBreaker(
+        "Open Food Facts",
+        failure_threshold=API_FAILURE_THRESHOLD,
+        reset_timeout=API_RESET_TIMEOUT,
+    ),
+    budget=RetryBudget(ratio=API_RETRY_RATIO, max_retries=API_MAX_RETRIES),
+    max_attempts=API_MAX_ATTEMPTS,
+    backoff=API_RETRY_BACKOFF,
+)
+# Cache the Open Food Facts product data by barcode (including "Product not found" results)
+product_cache = TieredCache(
+    "products",
+    max_size=PRODUCT_CACHE_SIZE,
+    ttl=PRODUCT_CACHE_TTL,
+    stale_ttl=PRODUCT_CACHE_STALE_TTL,
+    negative_ttl=PRODUCT_NOT_FOUND_TTL,
+    shared=True,
 )
 
 
+# Cache the Open Food Facts text search results by normalized query, page and page size
+search_cache = TieredCache(
+    "searches",
+    max_size=SEARCH_CACHE_SIZE,
+    ttl=SEARCH_CACHE_TTL,
+    negative_ttl=SEARCH_NOT_FOUND_TTL,
+)
+
+
+# Share one Open Food Facts call between concurrent requests for the same product or search
+openfoodfacts_flight = SingleFlight("openfoodfacts")
+
+
+# Function for fetching the product data by barcode from Open Food Facts API
+def load_product(product_barcode: str) -> dict:
+    def get_product() -> dict:
+        return openfoodfacts_client.call(
+            "product.get",
+            lambda: api.product.get(product_barcode, fields=product_schema),
+        )
+
+    # Waiting callers that time out get the same 503 as an open circuit
+    try:
+        return openfoodfacts_flight.run(
+            f"product:{product_barcode}", get_product, API_CALL_TIMEOUT
+        )
+    except TimeoutError:
+        raise UpstreamUnavailable(
+            "Open Food Facts did not respond in time. Try again later."
+        ) from None
+
+
+# Function for fetching the product data by barcode (Served from the local catalog or the product cache when possible)
+def fetch_product(product_barcode: str) -> dict:
+    product_data = find_product(product_barcode)
+    if product_data:
+        return product_data
+
+    return product_cache.fetch(product_barcode, lambda: load_product(product_barcode))
+
+
+# Function for building the search cache key
+def search_key(search_query: str, page: int, page_size: int) -> str:
+    return f"{search_query}|{page}|{page_size}"
+
+
+# Function for searching products by text from Open Food Facts API (Returns None if nothing is found)
+def load_search(search_query: str, page: int, page_size: int) -> dict:
+    def text_search() -> dict:
+        return openfoodfacts_client.call(
+            "text_search",
+            lambda: api.product.text_search(
+                search_query, page=page, page_size=page_size
+            ),
+        )
+
+    try:
+        search_result = openfoodfacts_flight.run(
+            f"search:{search_key(normalize_query(search_query), page, page_size)}",
+            text_search,
+            API_CALL_TIMEOUT,
+        )
+    except TimeoutError:
+        raise UpstreamUnavailable(
+            "Open Food Facts did not respond in time. Try again later."
+        ) from None
+    return search_result if search_result and search_result.get("products") else None
+
+
+# Function for searching products by text (Served from the local catalog or the search cache when possible)
+# Only the cache keys use the normalized query, Open Food Facts gets the query as typed
+def search_products(search_query: str, page: int, page_size: int) -> dict:
+    search_result = search_catalog(search_query, page, page_size)
+    if search_result:
+        return search_result
+
+    # Probe without recording a miss (The fetch below records the lookup once)
+    cache_query = normalize_query(search_query)
+    cache_key = search_key(cache_query, page, page_size)
+    found, _, _ = search_cache.read(cache_key)
+    if found:
+        return search_cache.fetch(
+            cache_key, lambda: load_search(search_query, page, page_size)
+        )
+
+    # Answer from a cached larger page that contains every requested product (if any)
+    start = (page - 1) * page_size
+    for cached_size in SEARCH_CACHE_PAGE_SIZES:
+        cached_page = start // cached_size + 1
+        if cached_size <= page_size or start + page_size > cached_page * cached_size:
+            continue
+
+        found, cached_result, _ = search_cache.read(
+            search_key(cache_query, cached_page, cached_size)
+        )
+        if not found:
+            continue
+        if not cached_result:
+            return None  # The larger page had no products, so neither does this one
+
+        offset = start - (cached_page - 1) * cached_size
+        products = cached_result["products"][offset : offset + page_size]
+        if not products:
+            return None
+
+        return {
+            **cached_result,
+            "products": products,
+            "page": page,
+            "page_size": page_size,
+            "page_count": len(products),
+            "skip": start,
+        }
+
+    return search_cache.fetch(
+        cache_key, lambda: load_search(search_query, page, page_size)
+    )
+
+
+# Function for filtering the additive numbers and cleaning the product data
+def filter_product(product_data: dict) -> dict:
+    product_data["additives_tags"] = filter_additive(
+        product_data.get("additives_tags", [])
+    )
+    return filter_data(product_data)
+
+
+# Function for building the minimal lumi() payload (only nutriments + ingredients)
+def lumi_payload(product_data: dict) -> dict:
+    return {
+        "nutriments": product_data.get("nutriments", {}),
+        "ingredients": product_data.get("ingredients", []),
+    }
+
+
+# Function for building the minimal swapr() payload
+def swapr_payload(product_data: dict) -> dict:
+    return {
+        "product_name": product_data.get("product_name", ""),
+        "categories": product_data.get("categories", ""),
+        "brands": product_data.get("brands", ""),
+        "ingredients": product_data.get("ingredients", []),
+        "additives_tags": product_data.get("additives_tags", []),
+        "nutriments": product_data.get("nutriments", {}),
+    }
+
+
+# Function for adding the mapped names, scores, images and AI analysis to the filtered product data
+def enrich_product(product_data: dict, lumi_result: dict, recommendation) -> dict:
+    nutriments = {
+        "positive_nutrient": lumi_result.get("positive_nutrient", []),
+        "negative_nutrient": lumi_result.get("negative_nutrient", []),
+    }
+    health_risk = {"ingredient_warnings": lumi_result.get("ingredient_warnings", [])}
+
+    product_data.update(
+        {
+            "additives_names": additive_name(
+                product_data.get("additives_tags", []),
+                additive_names,
+            ),
+            "ingredients": filter_ingredient(product_data.get("ingredients", [])),
+            "nova_group_name": nova_name(product_data.get("nova_group", "")),
+            "nutriments": nutriments,
+            "total_nutriments": len(nutriments.get("positive_nutrient", []))
+            + len(nutriments.get("negative_nutrient", [])),
+            "primary_score": primary_score(product_data),
+            "health_risk": health_risk,
+            "total_health_risks": len(health_risk.get("ingredient_warnings", [])),
+            "selected_images": filter_image(product_data.get("selected_images", {})),
+            "recommended_product": recommendation,
+        }
+    )
+    return product_data
+
+
+# Function for recommending a product with swapr() and looking up its details in Open Food Facts
+def recommend_product(email: str, product_payload: dict) -> dict:
+    rec_response = swapr(email, product_payload)
+    rec_name = rec_response.get("product_name", "")
+    if not rec_name or rec_name == "No recommendation available":
+        return rec_response
+
+    # Search for the recommended product details if available
+    try:
+        print(f"[Swapr] Searching for recommendation: {rec_name}")
+        rec_search = search_products(rec_name, page=1, page_size=1)
+        if not rec_search:
+            print(f"[Swapr] Not found in OpenFoodFacts: {rec_name}")
+            return {"product_name": rec_name}
+
+        rec_product = rec_search["products"][0]
+        print(
+            f"[Swapr] Found recommendation: {rec_product.get('product_name', rec_name)}"
+        )
+        return {
+            "product_name": rec_product.get("product_name", rec_name),
+            "brands": rec_product.get("brands", ""),
+            "selected_images": filter_image(rec_product.get("selected_images", {})),
+            "code": rec_product.get("code", ""),
+            "primary_score": primary_score(rec_product),
+            "nova_group": rec_product.get("nova_group", ""),
+        }
+    except Exception as e:
+        print(f"[Swapr] Search failed: {e}")
+        return {"product_name": rec_name}
+
+
+# Function for checking if the client asked for a streamed (NDJSON) search response
+def stream_requested() -> bool:
+    if request.args.get("stream", "false").lower() == "true":
+        return True
+    return (
+        request.accept_mimetypes.best_match(
+            ["application/json", "application/x-ndjson"]
+        )
+        == "application/x-ndjson"
+    )
+
+
+# Function for streaming a text search result as NDJSON records (Envelope, then each product, then the AI analysis of the first product)
+def stream_search(email: str, search_query: str, search_result: dict, metadata: dict):
+    try:
+        products = search_result.pop("products")
+        yield json.dumps({"type": "search", **search_result, **metadata}) + "\n"
+
+        # Start the AI analysis of the first product and send it without the analysis in the meantime
+        first_product = filter_product(products[0])
+        enrichment_start = time.monotonic()
+        lumi_future = submit(lumi, lumi_payload(first_product))
+        recommendation_future = submit(
+            recommend_product, email, swapr_payload(first_product)
+        )
+        preview_product = enrich_product(dict(first_product), lumi_fallback(), None)
+        yield (
+            json.dumps({"type": "product", "index": 0, "product": preview_product})
+            + "\n"
+        )
+
+        # Send each remaining product as soon as it is filtered (Released afterwards to keep the memory flat)
+        for index in range(1, len(products)):
+            product = enrich_product(
+                filter_product(products[index]), lumi_fallback(), None
+            )
+            products[index] = None
+            yield (
+                json.dumps({"type": "product", "index": index, "product": product})
+                + "\n"
+            )
+
+        # Send the first product again once its AI analysis is ready (Each falls back to an empty result after its deadline)
+        lumi_result = wait_for(
+            lumi_future, enrichment_start + LUMI_DEADLINE, lumi_fallback, "lumi"
+        )
+        recommendation = wait_for(
+            recommendation_future,
+            enrichment_start + RECOMMENDATION_DEADLINE,
+            swapr_fallback,
+            "recommend_product",
+        )
+        enrich_product(first_product, lumi_result, recommendation)
+        yield (
+            json.dumps({"type": "enrichment", "index": 0, "product": first_product})
+            + "\n"
+        )
+    except Exception as exc:
+        runtime_error("stream_search", str(exc), search_query=search_query)
+        yield json.dumps({"type": "error", "error": str(exc)}) + "\n"
+
+
+# Function for computing a deferred recommendation in the worker pool (Also added to the scan history once ready)
+def recommendation_job(
+    job_id: str, email: str, product_barcode: str, product_payload: dict
+) -> None:
+    try:
+        recommendation = swapr(email, product_payload)
+        save_recommendation_job(
+            job_id, {"status": "complete", "recommended_product": recommendation}
+        )
+        update_scan_recommendation(email, product_barcode, recommendation)
+    except Exception as exc:
+        runtime_error("recommendation_job", str(exc), job_id=job_id, email=email)
+        # End the job, so the client stops polling instead of waiting for it to expire
+        try:
+            save_recommendation_job(job_id, {"status": "failed"})
+        except Exception as exc:
+            runtime_error("recommendation_job", str(exc), job_id=job_id, email=email)
+
+
+# Function for starting a deferred recommendation and returning its job ID (Polled at /recommendation/<job_id>)
+def start_recommendation(
+    email: str, product_barcode: str, product_payload: dict
+) -> str:
+    job_id = secrets.token_urlsafe(16)
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=RECOMMENDATION_JOB_TTL)
+    save_recommendation_job(
+        job_id, {"status": "pending", "email": email, "expires_at": expires_at}
+    )
+    submit(recommendation_job, job_id, email, product_barcode, product_payload)
+    return job_id
+
+
 @search_blueprint.route("/barcode", methods=["GET"])
 def barcode() -> Response:
     try:
@@ -37,12 +421,16 @@ def barcode() -> Response:
         # Get the email and product barcode values from the incoming JSON data
         email = request.headers.get("Mivro-Email")
         product_barcode = request.args.get("product_barcode")
+        # Return a recommendation job ID instead of waiting for swapr() (Opt-in with ?defer_recommendation=true)
+        defer_recommendation = (
+            request.args.get("defer_recommendation", "false").lower() == "true"
+        )
 
         if not email or not product_barcode:
             return jsonify({"error": "Email and product barcode are required."}), 400
 
-        # Define product schema fields and fetch data from Open Food Facts API using barcode
-        product_data = api.product.get(product_barcode, fields=product_schema)
+        # Fetch the product data (product schema fields) from the cache or Open Food Facts API
+        product_data = fetch_product(product_barcode)
         if not product_data:
             # Store "Product not found" event in Firestore for analytics
             product_not_found("barcode", product_barcode)
@@ -56,42 +444,28 @@ def barcode() -> Response:
             )
 
         # Filter the additive numbers and clean the product data
-        product_data["additives_tags"] = filter_additive(
-            product_data.get("additives_tags", [])
-        )
-        filtered_product_data = filter_data(product_data)
+        filtered_product_data = filter_product(product_data)
 
         # Calculate the response time and size for the filtered product data
         end_time = datetime.now()
         response_time = (end_time - start_time).total_seconds()
         response_size = sys.getsizeof(filtered_product_data) / 1024
 
-        # Call lumi() with minimal payload (only nutriments + ingredients)
-        lumi_payload = {
-            "nutriments": filtered_product_data.get("nutriments", {}),
-            "ingredients": filtered_product_data.get("ingredients", []),
-        }
-        lumi_result = lumi(lumi_payload)
-        nutriments = {
-            "positive_nutrient": lumi_result.get("positive_nutrient", []),
-            "negative_nutrient": lumi_result.get("negative_nutrient", []),
-        }
-        health_risk = {
-            "ingredient_warnings": lumi_result.get("ingredient_warnings", [])
-        }
-
-        images = filter_image(filtered_product_data.get("selected_images", {}))
+        # Call lumi() and swapr() concurrently (Each falls back to an empty result after its deadline)
+        enrichment_start = time.monotonic()
+        product_payload = swapr_payload(filtered_product_data)
+        lumi_future = submit(lumi, lumi_payload(filtered_product_data))
+        if not defer_recommendation:
+            swapr_future = submit(swapr, email, product_payload)
 
-        # Call swapr() with minimal payload
-        swapr_payload = {
-            "product_name": filtered_product_data.get("product_name", ""),
-            "categories": filtered_product_data.get("categories", ""),
-            "brands": filtered_product_data.get("brands", ""),
-            "ingredients": filtered_product_data.get("ingredients", []),
-            "additives_tags": filtered_product_data.get("additives_tags", []),
-            "nutriments": filtered_product_data.get("nutriments", {}),
-        }
-        recommendation = swapr(email, swapr_payload)
+        lumi_result = wait_for(
+            lumi_future, enrichment_start + LUMI_DEADLINE, lumi_fallback, "lumi"
+        )
+        recommendation = None
+        if not defer_recommendation:
+            recommendation = wait_for(
+                swapr_future, enrichment_start + SWAPR_DEADLINE, swapr_fallback, "swapr"
+            )
 
         # Update the filtered product data with additional information for analytics
         filtered_product_data.update(
@@ -102,35 +476,174 @@ def barcode() -> Response:
                 "response_size": f"{response_size:.2f} KB",
                 "search_date": datetime.now().strftime("%Y-%m-%d"),
                 "search_time": datetime.now().strftime("%H:%M:%S"),
-                "additives_names": additive_name(
-                    filtered_product_data.get("additives_tags", []),
-                    additive_names,
-                ),
-                "ingredients": filter_ingredient(
-                    filtered_product_data.get("ingredients", [])
-                ),
-                "nova_group_name": nova_name(
-                    filtered_product_data.get("nova_group", "")
-                ),
-                "nutriments": nutriments,
-                "total_nutriments": len(nutriments.get("positive_nutrient", []))
-                + len(nutriments.get("negative_nutrient", [])),
-                "primary_score": primary_score(filtered_product_data),
-                "health_risk": health_risk,
-                "total_health_risks": len(health_risk.get("ingredient_warnings", [])),
-                "selected_images": images,
-                "recommended_product": recommendation,
             }
         )
+        enrich_product(filtered_product_data, lumi_result, recommendation)
 
         # Store the scan history for the product barcode in Firestore
         database_history(email, product_barcode, filtered_product_data)
+
+        # Start the deferred recommendation after the scan history is queued (Its update is written afterwards)
+        if defer_recommendation:
+            filtered_product_data["recommendation_job"] = start_recommendation(
+                email, product_barcode, product_payload
+            )
         return jsonify(filtered_product_data)
+    except UpstreamUnavailable as exc:
+        return jsonify({"error": str(exc)}), 503
     except Exception as exc:
         runtime_error("barcode", str(exc), product_barcode=product_barcode)
         return jsonify({"error": str(exc)}), 500
 
 
+@search_blueprint.route("/recommendation/<job_id>", methods=["GET"])
+def recommendation(job_id: str) -> Response:
+    try:
+        # Get email value from the request headers
+        email = request.headers.get("Mivro-Email")
+        if not email:
+            return jsonify({"error": "Email is required."}), 400
+
+        # Retrieve the recommendation job (Only the user who started it can read it)
+        recommendation_data = load_recommendation_job(job_id)
+        if not recommendation_data or recommendation_data.get("email") != email:
+            return jsonify({"error": "Recommendation job not found."}), 404
+
+        if recommendation_data["status"] == "pending":
+            return jsonify({"status": "pending"}), 202
+        if recommendation_data["status"] == "failed":
+            return jsonify({"status": "failed", "error": "Recommendation failed."})
+
+        return jsonify(
+            {
+                "status": "complete",
+                "recommended_product": recommendation_data["recommended_product"],
+            }
+        )
+    except Exception as exc:
+        runtime_error("recommendation", str(exc), job_id=job_id)
+        return jsonify({"error": str(exc)}), 500
+
+
+@search_blueprint.route("/batch-barcode", methods=["POST"])
+def batch_barcode() -> Response:
+    try:
+        # Start the timer for measuring the response time
+        start_time = datetime.now()
+        # Get the email and product barcode values from the incoming JSON data
+        email = request.headers.get("Mivro-Email")
+        product_barcodes = (request.get_json(silent=True) or {}).get("product_barcodes")
+
+        if not email or not isinstance(product_barcodes, list) or not product_barcodes:
+            return (
+                jsonify(
+                    {"error": "Email and a list of product barcodes are required."}
+                ),
+                400,
+            )
+
+        # Remove duplicate barcodes (Keeping the order) and limit the batch size
+        product_barcodes = list(
+            dict.fromkeys(str(barcode).strip() for barcode in product_barcodes)
+        )
+        product_barcodes = [barcode for barcode in product_barcodes if barcode]
+        if not product_barcodes or len(product_barcodes) > BATCH_MAX_BARCODES:
+            return (
+                jsonify(
+                    {"error": f"Between 1 and {BATCH_MAX_BARCODES} barcodes allowed."}
+                ),
+                400,
+            )
+
+        # Fetch the product data of every barcode concurrently (Each item gets its own result or error)
+        product_futures = run_bounded(
+            [partial(fetch_product, barcode) for barcode in product_barcodes],
+            BATCH_FETCH_CONCURRENCY,
+        )
+        batch_results, found_products = {}, {}
+        for product_barcode, product_future in zip(product_barcodes, product_futures):
+            if isinstance(product_future.exception(), UpstreamUnavailable):
+                batch_results[product_barcode] = {
+                    "error": str(product_future.exception()),
+                    "status": 503,
+                }
+            elif product_future.exception():
+                error_message = str(product_future.exception())
+                runtime_error(
+                    "batch_barcode", error_message, product_barcode=product_barcode
+                )
+                batch_results[product_barcode] = {"error": error_message, "status": 500}
+            elif not product_future.result():
+                # Store "Product not found" event in Firestore for analytics
+                product_not_found("barcode", product_barcode)
+                batch_results[product_barcode] = {
+                    "error": "Product not found.",
+                    "status": 404,
+                }
+            else:
+                found_products[product_barcode] = filter_product(
+                    product_future.result()
+                )
+
+        # Call lumi() and swapr() for every product at batch priority with a bounded fan-out (Unfinished calls fall back to an empty result after the deadline)
+        enrichment_calls = []
+        for product_data in found_products.values():
+            enrichment_calls.append(partial(lumi, lumi_payload(product_data), "batch"))
+            enrichment_calls.append(
+                partial(swapr, email, swapr_payload(product_data), "batch")
+            )
+        enrichment_futures = run_bounded(
+            enrichment_calls,
+            BATCH_ENRICHMENT_CONCURRENCY,
+            time.monotonic() + BATCH_ENRICHMENT_DEADLINE,
+        )
+
+        for index, (product_barcode, product_data) in enumerate(found_products.items()):
+            lumi_result = future_result(
+                enrichment_futures[2 * index], lumi_fallback, "lumi"
+            )
+            recommendation = future_result(
+                enrichment_futures[2 * index + 1], swapr_fallback, "swapr"
+            )
+
+            # Update the product data with additional information for analytics
+            product_data.update(
+                {
+                    "search_type": "Open Food Facts API - Batch Barcode",
+                    "search_response": "200 OK",
+                    "search_date": datetime.now().strftime("%Y-%m-%d"),
+                    "search_time": datetime.now().strftime("%H:%M:%S"),
+                }
+            )
+            enrich_product(product_data, lumi_result, recommendation)
+
+            # Queue the scan history (The write queue commits the whole batch as one Firestore batched write)
+            database_history(email, product_barcode, product_data)
+            batch_results[product_barcode] = {"product": product_data, "status": 200}
+
+        # Calculate the response time for the whole batch
+        end_time = datetime.now()
+        response_time = (end_time - start_time).total_seconds()
+
+        return jsonify(
+            {
+                "results": [
+                    {
+                        "product_barcode": product_barcode,
+                        **batch_results[product_barcode],
+                    }
+                    for product_barcode in product_barcodes
+                ],
+                "total_products": len(product_barcodes),
+                "found_products": len(found_products),
+                "response_time": f"{response_time:.2f} seconds",
+            }
+        )
+    except Exception as exc:
+        runtime_error("batch_barcode", str(exc))
+        return jsonify({"error": str(exc)}), 500
+
+
 @search_blueprint.route("/text", methods=["GET"])
 def text() -> Response:
     try:
@@ -148,12 +661,9 @@ def text() -> Response:
         # Limit page size to prevent excessive API calls
         page_size = min(page_size, 100)
 
-        # Perform text search using Open Food Facts API
-        search_result = api.product.text_search(
-            search_query, page=page, page_size=page_size
-        )
-
-        if not search_result or not search_result.get("products"):
+        # Perform text search using the search cache or Open Food Facts API
+        search_result = search_products(search_query, page, page_size)
+        if not search_result:
             # Store "Product not found" event in Firestore for analytics
             product_not_found("text", search_query)
             return jsonify({"error": "No products found."}), 404
@@ -162,115 +672,50 @@ def text() -> Response:
         end_time = datetime.now()
         response_time = (end_time - start_time).total_seconds()
 
-        # Process products and perform AI analysis on first result only
-        processed_products = []
-        for idx, product in enumerate(search_result.get("products", [])):
-            # Filter and clean the product data
-            product["additives_tags"] = filter_additive(
-                product.get("additives_tags", [])
+        # Stream the products as they are processed (Opt-in with ?stream=true or "Accept: application/x-ndjson")
+        if stream_requested():
+            metadata = {
+                "search_type": "Open Food Facts API - Text",
+                "search_response": "200 OK",
+                "response_time": f"{response_time:.2f} seconds",
+                "search_date": datetime.now().strftime("%Y-%m-%d"),
+                "search_time": datetime.now().strftime("%H:%M:%S"),
+                "query": search_query,
+            }
+            return Response(
+                stream_with_context(
+                    stream_search(email, search_query, search_result, metadata)
+                ),
+                mimetype="application/x-ndjson",
             )
-            filtered_product = filter_data(product)
-
-            # Perform AI analysis on first product only
-            if idx == 0:
-                # Call lumi() with minimal payload (only nutriments + ingredients)
-                lumi_payload = {
-                    "nutriments": filtered_product.get("nutriments", {}),
-                    "ingredients": filtered_product.get("ingredients", []),
-                }
-                lumi_result = lumi(lumi_payload)
-                nutriments = {
-                    "positive_nutrient": lumi_result.get("positive_nutrient", []),
-                    "negative_nutrient": lumi_result.get("negative_nutrient", []),
-                }
-                health_risk = {
-                    "ingredient_warnings": lumi_result.get("ingredient_warnings", [])
-                }
-
-                images = filter_image(filtered_product.get("selected_images", {}))
 
-                # Get product recommendation with minimal payload
-                swapr_payload = {
-                    "product_name": filtered_product.get("product_name", ""),
-                    "categories": filtered_product.get("categories", ""),
-                    "brands": filtered_product.get("brands", ""),
-                    "ingredients": filtered_product.get("ingredients", []),
-                    "additives_tags": filtered_product.get("additives_tags", []),
-                    "nutriments": filtered_product.get("nutriments", {}),
-                }
-                rec_response = swapr(email, swapr_payload)
-                rec_name = rec_response.get("product_name", "")
-
-                # Search for the recommended product details if available
-                if rec_name and rec_name != "No recommendation available":
-                    try:
-                        print(f"[Swapr] Searching for recommendation: {rec_name}")
-                        rec_search = api.product.text_search(
-                            rec_name, page=1, page_size=1
-                        )
-
-                        if rec_search and rec_search.get("products"):
-                            rec_product = rec_search["products"][0]
-                            print(
-                                f"[Swapr] Found recommendation: {rec_product.get('product_name', rec_name)}"
-                            )
-
-                            # Get and filter images for recommendation
-                            rec_images = filter_image(
-                                rec_product.get("selected_images", {})
-                            )
-
-                            recommendation = {
-                                "product_name": rec_product.get(
-                                    "product_name", rec_name
-                                ),
-                                "brands": rec_product.get("brands", ""),
-                                "selected_images": rec_images,
-                                "code": rec_product.get("code", ""),
-                                "primary_score": primary_score(rec_product),
-                                "nova_group": rec_product.get("nova_group", ""),
-                            }
-                        else:
-                            print(f"[Swapr] Not found in OpenFoodFacts: {rec_name}")
-                            recommendation = {"product_name": rec_name}
-                    except Exception as e:
-                        print(f"[Swapr] Search failed: {e}")
-                        recommendation = {"product_name": rec_name}
-                else:
-                    recommendation = rec_response
-            else:
-                nutriments = {"positive_nutrient": [], "negative_nutrient": []}
-                health_risk = {"ingredient_warnings": []}
-                images = filter_image(filtered_product.get("selected_images", {}))
-                recommendation = None
+        # Start the AI analysis of the first product only (lumi and the swapr -> Open Food Facts lookup run concurrently)
+        products = search_result.get("products", [])
+        first_product = filter_product(products[0])
+        enrichment_start = time.monotonic()
+        lumi_future = submit(lumi, lumi_payload(first_product))
+        recommendation_future = submit(
+            recommend_product, email, swapr_payload(first_product)
+        )
 
-            # Add enriched data for each product
-            filtered_product.update(
-                {
-                    "additives_names": additive_name(
-                        filtered_product.get("additives_tags", []),
-                        additive_names,
-                    ),
-                    "ingredients": filter_ingredient(
-                        filtered_product.get("ingredients", [])
-                    ),
-                    "nova_group_name": nova_name(
-                        filtered_product.get("nova_group", "")
-                    ),
-                    "nutriments": nutriments,
-                    "total_nutriments": len(nutriments.get("positive_nutrient", []))
-                    + len(nutriments.get("negative_nutrient", [])),
-                    "primary_score": primary_score(filtered_product),
-                    "health_risk": health_risk,
-                    "total_health_risks": len(
-                        health_risk.get("ingredient_warnings", [])
-                    ),
-                    "selected_images": images,
-                    "recommended_product": recommendation,
-                }
+        # Filter and enrich the remaining products while the AI analysis runs
+        processed_products = [first_product]
+        for product in products[1:]:
+            processed_products.append(
+                enrich_product(filter_product(product), lumi_fallback(), None)
             )
 
-            processed_products.append(filtered_product)
+        # Wait for the AI analysis of the first product (Each falls back to an empty result after its deadline)
+        lumi_result = wait_for(
+            lumi_future, enrichment_start + LUMI_DEADLINE, lumi_fallback, "lumi"
+        )
+        recommendation = wait_for(
+            recommendation_future,
+            enrichment_start + RECOMMENDATION_DEADLINE,
+            swapr_fallback,
+            "recommend_product",
+        )
+        enrich_product(first_product, lumi_result, recommendation)
 
         # Update the search result with metadata
         search_result.update(
@@ -287,52 +732,52 @@ def text() -> Response:
         )
 
         return jsonify(search_result)
+    except UpstreamUnavailable as exc:
+        return jsonify({"error": str(exc)}), 503
     except Exception as exc:
         runtime_error("text", str(exc), search_query=search_query)
         return jsonify({"error": str(exc)}), 500
 
 
-# DEPRECATED: database search endpoint - replaced by text search (OpenFoodFacts API v3.3.0)
-# Kept for backward compatibility and as cache fallback
-# # @search_blueprint.route("/database", methods=["GET"])
-# def database() -> Response:
-#     try:
-#         # Start the timer for measuring the response time
-#         start_time = datetime.now()
-#         # Get the email and product keyword values from the incoming JSON data
-#         email = request.headers.get("Mivro-Email")
-#         product_keyword = request.args.get("product_keyword")
-
-#         if not email or not product_keyword:
-#             return jsonify({"error": "Email and product keyword are required."}), 400
-
-#         # Define the search keys and fetch the product data from Firestore using the keyword (fuzzy matching)
-#         search_keys = ["_keywords", "categories", "product_name"]
-#         product_data = database_search(email, product_keyword, search_keys)
-
-#         if product_data:
-#             # Calculate the response time and size for the product data from Firestore
-#             end_time = datetime.now()
-#             response_time = (end_time - start_time).total_seconds()
-#             response_size = sys.getsizeof(product_data) / 1024
-
-#             # Update the product data with additional information for analytics
-#             product_data.update(
-#                 {
-#                     "search_type": "Google Firestore Database",
-#                     "search_response": "200 OK",
-#                     "response_time": f"{response_time:.2f} seconds",
-#                     "response_size": f"{response_size:.2f} KB",
-#                     "search_date": datetime.now().strftime("%d-%B-%Y"),
-#                     "search_time": datetime.now().strftime("%I:%M %p"),
-#                 }
-#             )
-
-#             return jsonify(product_data)
-
-#         # Store "Product not found" event in Firestore for analytics
-#         product_not_found("database", product_keyword)
-#         return jsonify({"error": "Product not found."}), 404
-#     except Exception as exc:
-#         runtime_error("database", str(exc), product_keyword=product_keyword)
-#         return jsonify({"error": str(exc)}), 500
+# Keyword search over the products scanned by every user (Fallback when the text search finds nothing)
+@search_blueprint.route("/database", methods=["GET"])
+def database() -> Response:
+    try:
+        # Start the timer for measuring the response time
+        start_time = datetime.now()
+        # Get the email and product keyword values from the incoming JSON data
+        email = request.headers.get("Mivro-Email")
+        product_keyword = request.args.get("product_keyword")
+
+        if not email or not product_keyword:
+            return jsonify({"error": "Email and product keyword are required."}), 400
+
+        # Fetch the product data scanned by any user from Firestore using the keyword (fuzzy matching)
+        product_data = database_search(email, product_keyword, SCAN_SEARCH_KEYS)
+
+        if product_data:
+            # Calculate the response time and size for the product data from Firestore
+            end_time = datetime.now()
+            response_time = (end_time - start_time).total_seconds()
+            response_size = sys.getsizeof(product_data) / 1024
+
+            # Update the product data with additional information for analytics
+            product_data.update(
+                {
+                    "search_type": "Google Firestore Database",
+                    "search_response": "200 OK",
+                    "response_time": f"{response_time:.2f} seconds",
+                    "response_size": f"{response_size:.2f} KB",
+                    "search_date": datetime.now().strftime("%d-%B-%Y"),
+                    "search_time": datetime.now().strftime("%I:%M %p"),
+                }
+            )
+
+            return jsonify(product_data)
+
+        # Store "Product not found" event in Firestore for analytics
+        product_not_found("database", product_keyword)
+        return jsonify({"error": "Product not found."}), 404
+    except Exception as exc:
+        runtime_error("database", str(exc), product_keyword=product_keyword)
+        return jsonify({"error": str(exc)}), 500
@@ -0,0 +1,256 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import SHED_CALLS, UPSTREAM_RETRIES, track_upstream
+
+
+# Exception raised when the circuit breaker of an upstream service is open (Fails fast instead of waiting on timeouts)
+class UpstreamUnavailable(Exception):
+    pass
+
+
+# HTTP adapter with a pooled keep-alive connection pool and separate connect and read timeouts for every request
+class TimeoutAdapter(HTTPAdapter):
+    def __init__(self, connect_timeout: float, read_timeout: float, **kwargs):
+        self.timeout = (connect_timeout, read_timeout)
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+# Retry budget: each call earns a fraction of a retry, so retries stay a small share of the traffic during an incident
+class RetryBudget:
+    def __init__(self, ratio: float, max_retries: int):
+        self.ratio = ratio
+        self.max_retries = max_retries
+        self.tokens = float(max_retries)
+        self.lock = threading.Lock()
+
+    # Function for adding the share of a retry earned by a call
+    def deposit(self) -> None:
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_retries)
+
+    # Function for taking a retry from the budget (Returns False if the budget is spent)
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+# Circuit breaker: opens after consecutive failures, then lets one trial call through after the reset timeout
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_count = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    # Function for checking if a call may be sent to the upstream service
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or (
+                time.monotonic() - self.opened_at < self.reset_timeout
+            ):
+                return False
+            self.trial_running = True  # Half-open, a single trial call decides
+            return True
+
+    # Function for recording a successful call (Closes the circuit)
+    def record_success(self) -> None:
+        with self.lock:
+            if self.opened_at is not None:
+                print(f"[Upstream] Circuit for {self.name} closed.")
+            self.failure_count = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    # Function for recording a failed call (Opens the circuit after too many consecutive failures)
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failure_count += 1
+            self.trial_running = False
+            if self.opened_at is not None or (
+                self.failure_count >= self.failure_threshold
+            ):
+                if self.opened_at is None:
+                    print(f"[Upstream] Circuit for {self.name} opened.")
+                self.opened_at = time.monotonic()
+
+
+# Function for checking if a failed call is worth retrying (Connection errors, timeouts, 429 and 5xx responses)
+# Unparsable bodies count too (A 200 response with an HTML error or maintenance page is an outage, not a bad request)
+def retryable_error(exc: Exception) -> bool:
+    if isinstance(
+        exc, (requests.ConnectionError, requests.Timeout, requests.JSONDecodeError)
+    ):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return False
+
+
+# Client wrapper for an upstream service (Circuit breaker, budgeted retries with jittered backoff, and metrics)
+class UpstreamClient:
+    def __init__(
+        self,
+        service: str,
+        breaker: CircuitBreaker,
+        budget: RetryBudget,
+        max_attempts: int,
+        backoff: float,
+    ):
+        self.service = service
+        self.breaker = breaker
+        self.budget = budget
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    # Function for calling the upstream service (Raises UpstreamUnavailable while the circuit is open)
+    def call(self, operation: str, function):
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(
+                f"{self.breaker.name} is unavailable. Try again later."
+            )
+
+        self.budget.deposit()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with track_upstream(self.service, operation):
+                    result = function()
+                self.breaker.record_success()
+                return result
+            except Exception as exc:
+                if not retryable_error(exc):
+                    self.breaker.record_success()  # The service answered, the request was invalid
+                    raise
+                if attempt == self.max_attempts or not self.budget.withdraw():
+                    self.breaker.record_failure()
+                    raise
+
+            # Wait a random share of the exponential backoff (Spreads the retries of concurrent callers)
+            UPSTREAM_RETRIES.labels(self.service, operation).inc()
+            time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+
+# Exception raised when a call waited too long for the scheduler (Low priority calls are shed first)
+class SchedulerOverloaded(Exception):
+    pass
+
+
+# Function for checking if a failed call was rejected by the rate limit of the upstream service (429 / RESOURCE_EXHAUSTED)
+def rate_limited(exc: Exception) -> bool:
+    return getattr(exc, "code", None) == 429 or "RESOURCE_EXHAUSTED" in str(exc)
+
+
+# Scheduler for the calls to a rate-limited upstream service (Concurrency limit, adaptive token bucket and priority classes)
+# Calls are admitted highest priority first, and each priority class only waits up to its own queue timeout
+class CallScheduler:
+    def __init__(
+        self,
+        service: str,
+        max_in_flight: int,
+        rate: float,
+        burst: int,
+        min_rate: float,
+        queue_timeouts: dict,
+    ):
+        self.service = service
+        self.max_in_flight = max_in_flight
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.queue_timeouts = (
+            queue_timeouts  # Priority name -> seconds, highest priority first
+        )
+        self.priorities = {name: rank for rank, name in enumerate(queue_timeouts)}
+        self.in_flight = 0
+        self.waiting = []  # Heap of (priority rank, arrival order)
+        self.arrivals = itertools.count()
+        self.condition = threading.Condition()
+
+    # Function for adding the tokens earned since the last update (Called with the condition held)
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Function for waiting until the call may start (Raises SchedulerOverloaded after the queue timeout of its priority)
+    def acquire(self, priority: str) -> None:
+        deadline = time.monotonic() + self.queue_timeouts[priority]
+        with self.condition:
+            entry = (self.priorities[priority], next(self.arrivals))
+            heapq.heappush(self.waiting, entry)
+            while True:
+                self.refill()
+                if (
+                    self.waiting[0] == entry
+                    and self.in_flight < self.max_in_flight
+                    and self.tokens >= 1
+                ):
+                    heapq.heappop(self.waiting)
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.condition.notify_all()  # The next call in line may start as well
+                    return
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.condition.notify_all()
+                    SHED_CALLS.labels(self.service, priority).inc()
+                    raise SchedulerOverloaded(
+                        f"{self.service} is busy, {priority} call shed."
+                    )
+
+                # Sleep until the next token is due, a call finishes or the queue timeout passes
+                if self.tokens < 1:
+                    remaining = min(remaining, (1 - self.tokens) / self.rate)
+                self.condition.wait(remaining)
+
+    # Function for finishing a call (Halves the rate after a rate limit error, then recovers it step by step)
+    def release(self, throttled: bool) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.refill()
+            if throttled:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = 0
+                print(
+                    f"[Upstream] {self.service} rate limited, rate lowered to {self.rate:.2f}/s."
+                )
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            self.condition.notify_all()
+
+    # Context manager for running a call in a scheduler slot
+    @contextmanager
+    def slot(self, priority: str):
+        self.acquire(priority)
+        throttled = False
+        try:
+            yield
+        except Exception as exc:
+            throttled = rate_limited(exc)
+            raise
+        finally:
+            self.release(throttled)
@@ -1,8 +1,16 @@
 from flask import Blueprint, Response, jsonify, request
 from firebase_admin import auth, firestore
 from models import FavoriteProduct, HealthProfile
+from utils import history_page_size
+from config import SCAN_SUMMARY_FIELDS
 from database import (
+    array_page,
+    clear_user_history,
+    history_page,
+    scan_reference,
     flagged_reference,
+    invalidate_user_document,
+    load_user_document,
     runtime_error,
     save_health_profile,
     user_reference,
@@ -20,14 +28,78 @@ def load_profile() -> Response:
         return jsonify({"error": "Email is required."}), 400
 
     try:
-        # Reference the user document by email and retrieve the user profile data
-        user_document = user_reference.document(email)
-        return jsonify(user_document.get().to_dict())
+        # Retrieve the user profile data (Without the history fields with history=false, served by the paginated history routes)
+        user_data = load_user_document(email).to_dict()
+        if request.args.get("history", "true").lower() == "false":
+            history_fields = ["favorite_products", "search_history"]
+            user_data = {
+                key: value
+                for key, value in user_data.items()
+                if key not in history_fields
+            }
+        return jsonify(user_data)
     except Exception as exc:
         runtime_error("load_profile", str(exc), email=email)
         return jsonify({"error": str(exc)}), 500
 
 
+@user_blueprint.route("/scan-history", methods=["GET"])
+def scan_history() -> Response:
+    # Get email value from the request headers
+    email = request.headers.get("Mivro-Email")
+    if not email:
+        return jsonify({"error": "Email is required."}), 400
+
+    try:
+        # Retrieve one page of the scan history, newest first by first scan (Summaries unless fields=full)
+        field_paths = (
+            None if request.args.get("fields") == "full" else SCAN_SUMMARY_FIELDS
+        )
+        scan_page = history_page(
+            scan_reference(email),
+            "scanned_at",
+            history_page_size(request.args),
+            cursor=request.args.get("cursor"),
+            field_paths=field_paths,
+        )
+        return jsonify(scan_page)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    except Exception as exc:
+        runtime_error("scan_history", str(exc), email=email)
+        return jsonify({"error": str(exc)}), 500
+
+
+@user_blueprint.route("/favorite-products", methods=["GET"])
+@user_blueprint.route("/search-history", methods=["GET"])
+def array_history() -> Response:
+    # Get email value from the request headers
+    email = request.headers.get("Mivro-Email")
+    if not email:
+        return jsonify({"error": "Email is required."}), 400
+
+    # Map the request path to the corresponding Firestore field to read
+    path_map = {
+        "/api/v1/user/favorite-products": "favorite_products",
+        "/api/v1/user/search-history": "search_history",
+    }
+
+    try:
+        # Retrieve one page of the history field, most recent entry first
+        history_data = array_page(
+            email,
+            path_map.get(request.path),
+            history_page_size(request.args),
+            cursor=request.args.get("cursor"),
+        )
+        return jsonify(history_data)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    except Exception as exc:
+        runtime_error("array_history", str(exc), email=email)
+        return jsonify({"error": str(exc)}), 500
+
+
 @user_blueprint.route("/update-profile", methods=["PUT"])
 def update_profile() -> Response:
     # Get email value from the request headers
@@ -73,6 +145,7 @@ def update_profile() -> Response:
         # Update the user document with the provided data
         if update_data:
             user_document.update(update_data)
+            invalidate_user_document(email)
             return jsonify({"message": "Profile updated successfully."})
         else:
             return jsonify({"message": "No changes detected."})
@@ -141,6 +214,7 @@ def favorite_product() -> Response:
             {"favorite_products": firestore.ArrayUnion([favorite_product.to_dict()])},
             merge=True,
         )  # Merge the favorite product with the existing user document (if any)
+        invalidate_user_document(email)
 
         return jsonify({"message": "Favorite product added successfully."})
     except Exception as exc:
@@ -207,9 +281,11 @@ def clear_history() -> Response:
     }
 
     try:
-        # Reference the user document by email and clear the specified history field
+        # Clear the history subcollection (if any) and the specified history field
+        clear_user_history(email, path_map.get(request.path))
         user_document = user_reference.document(email)
         user_document.update({path_map.get(request.path): firestore.DELETE_FIELD})
+        invalidate_user_document(email)
 
         formatted_message = (
             f"{path_map.get(request.path).replace('_', ' ').capitalize()}"
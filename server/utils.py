@@ -1,8 +1,11 @@
 import json
+import unicodedata
 from pathlib import Path
 
-from mapping import food_icon
-from database import user_reference
+from mapping import food_icon, icon_index
+from firebase_admin import firestore
+from database import chat_reference, load_user_document
+from config import HISTORY_MAX_PAGE_SIZE, HISTORY_PAGE_SIZE
 
 METADATA_DIR = Path(__file__).parent.parent / "metadata"
 
@@ -10,6 +13,9 @@ METADATA_DIR = Path(__file__).parent.parent / "metadata"
 with open(METADATA_DIR / "food_categories.json") as file:
     food_categories = json.load(file)
 
+# Compile the food categories into a reverse lookup for the ingredient and nutrient icons
+food_icons = icon_index(food_categories)
+
 with open(METADATA_DIR / "additive_names.json") as file:
     additive_names = json.load(file)
 
@@ -17,6 +23,15 @@ with open(METADATA_DIR / "product_schema.json") as file:
     product_schema = json.load(file)
 
 
+# Function for normalizing a search query or product text (Used in search.py and catalog.py)
+def normalize_query(search_query: str) -> str:
+    decomposed_query = unicodedata.normalize("NFKD", search_query)
+    stripped_query = "".join(
+        char for char in decomposed_query if not unicodedata.combining(char)
+    )
+    return " ".join(stripped_query.casefold().split())
+
+
 # Function for filtering additive tags and removing the 'i' suffix (Used in search.py)
 def filter_additive(additive_data: list) -> list:
     additive_info = [tag for tag in additive_data if not tag.endswith("i")]
@@ -28,7 +43,7 @@ def filter_ingredient(ingredient_data: list) -> list:
     ingredient_info = [
         {
             "name": ingredient.get("text", "").title(),
-            "icon": food_icon(ingredient.get("text", "").title(), food_categories),
+            "icon": food_icon(ingredient.get("text", "").title(), food_icons),
             "percentage": f"{abs(float(ingredient.get('percent_estimate', 0))):.2f} %",
         }
         for ingredient in ingredient_data
@@ -42,7 +57,7 @@ def filter_nutriment(nutriment_data: dict) -> dict:
     for category in ["negative_nutrient", "positive_nutrient"]:
         if category in nutriment_data:
             for nutrient in nutriment_data[category]:
-                nutrient["icon"] = food_icon(nutrient.get("name", ""), food_categories)
+                nutrient["icon"] = food_icon(nutrient.get("name", ""), food_icons)
     return nutriment_data
 
 
@@ -55,7 +70,7 @@ def analyse_nutrient(nutrient_data: dict, nutrient_limits: dict) -> dict:
     nutrient_map = {
         nutrient: {
             "name": nutrient.title(),
-            "icon": food_icon(nutrient.title(), food_categories),
+            "icon": food_icon(nutrient.title(), food_icons),
             "quantity": f"{abs(float(nutrient_data.get(f'{nutrient}_100g', 0))):.2f} {value['unit']}",
         }
         for nutrient, value in nutrient_limits.items()
@@ -129,20 +144,23 @@ def filter_image(image_data: dict) -> dict:
 
 # Function for retrieving the user's health profile from Firestore (Used in gemini.py)
 def health_profile(email: str) -> dict:
-    user_document = user_reference.document(email)
-    health_profile = user_document.get().to_dict().get("health_profile", {})
+    user_data = load_user_document(email).to_dict() or {}
+    health_profile = user_data.get("health_profile", {})
     return health_profile
 
 
 # Function for storing the chat history in Firestore (Used in gemini.py)
 def chat_history(email: str, chat_entry: dict) -> None:
-    user_document = user_reference.document(email)
-    if not user_document.get().exists:
-        user_document.set({"chat_history": []})
+    # Append the chat entry as its own document (The server timestamp orders the history)
+    chat_reference(email).add(
+        {**chat_entry.to_dict(), "created_at": firestore.SERVER_TIMESTAMP}
+    )
+
 
-    chat_history = user_document.get().to_dict().get("chat_history", [])
-    chat_history.append(chat_entry.to_dict())
-    user_document.set({"chat_history": chat_history}, merge=True)
+# Function for reading the page size of a history request (Used in user.py and chat.py)
+def history_page_size(request_args: dict) -> int:
+    page_size = request_args.get("page_size", HISTORY_PAGE_SIZE, type=int)
+    return max(1, min(page_size, HISTORY_MAX_PAGE_SIZE))
 
 
 # Function for calculating the BMI based on the weight and height (Used in models.py)
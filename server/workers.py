@@ -0,0 +1,112 @@
+import contextvars
+import copy
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from config import WORKER_POOL_SIZE
+from database import runtime_error
+from metrics import COALESCED_CALLS
+
+# Shared thread pool for running blocking upstream calls (Gemini, Open Food Facts) concurrently
+executor = ThreadPoolExecutor(
+    max_workers=WORKER_POOL_SIZE, thread_name_prefix="mivro-worker"
+)
+
+
+# Function for running a call in the thread pool (Copies the Flask request context into the worker)
+def submit(function, *args, **kwargs) -> Future:
+    context = contextvars.copy_context()
+    return executor.submit(context.run, function, *args, **kwargs)
+
+
+# Single-flight group: concurrent calls with the same key wait on one in-flight call and share its result
+# (Keeps a burst of identical requests from reaching the upstream API before the cache is populated)
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = {}  # Key -> (future, deadline) of the in-flight call
+        self.lock = threading.Lock()
+
+    # Function for running the call, or waiting for the identical call already in flight
+    # The timeout is the longest the call can take, waiting callers give up at the deadline of the first one
+    def run(self, key: str, function, timeout: float):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = (Future(), time.monotonic() + timeout)
+        future, deadline = call
+
+        if not leader:
+            COALESCED_CALLS.labels(self.name).inc()
+            try:
+                result = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                raise TimeoutError(
+                    f"Timed out waiting for the in-flight {self.name} call."
+                ) from None
+            return copy.deepcopy(result)  # Each caller gets its own copy to mutate
+
+        try:
+            result = function()
+            future.set_result(copy.deepcopy(result))
+            return result
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+
+# Function for running calls in the thread pool with at most `limit` of them in flight (Keeps one batch from filling the pool)
+# Returns the finished future of each call in order, or None for the calls that did not finish before the deadline
+def run_bounded(calls: list, limit: int, deadline: float = None) -> list:
+    futures = [None] * len(calls)
+    pending = {}
+    next_index = 0
+
+    while next_index < len(calls) or pending:
+        # Keep the window full while there is time left
+        while next_index < len(calls) and len(pending) < limit:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            pending[submit(calls[next_index])] = next_index
+            next_index += 1
+        if not pending:
+            break
+
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            break  # Deadline exceeded, the unfinished calls are left to complete in the background
+        for future in done:
+            futures[pending.pop(future)] = future
+
+    return futures
+
+
+# Function for waiting on a call until its deadline (Returns the fallback value on timeout or error)
+def wait_for(future: Future, deadline: float, fallback, function_name: str):
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        runtime_error(function_name, "Deadline exceeded, fallback returned.")
+        return fallback()
+    except Exception as exc:
+        runtime_error(function_name, str(exc))
+        return fallback()
+
+
+# Function for reading the result of a call started by run_bounded (Returns the fallback value if it did not finish or failed)
+def future_result(future: Future, fallback, function_name: str):
+    if future is None:
+        runtime_error(function_name, "Deadline exceeded, fallback returned.")
+        return fallback()
+    try:
+        return future.result()
+    except Exception as exc:
+        runtime_error(function_name, str(exc))
+        return fallback()